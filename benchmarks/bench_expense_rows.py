@@ -0,0 +1,186 @@
+"""Micro-benchmark for the ledger report path behind /status.
+
+LedgerMirror builds its report index (PeriodAggregator) from the sheet rows
+through _parse_expense_row, then /status, /week and /month read every window
+from it with summarize_windows. This compares that build with the old
+row parsing (strptime on every row, plain attribute objects without
+interning) on a synthetic multi-year ledger, and times one /status call.
+It also measures with tracemalloc the memory held by the parsed records
+and by the built index. Results are checked against a plain per-row
+reference sum.
+
+Run from the repo root:  python benchmarks/bench_expense_rows.py
+"""
+import os
+import random
+import sys
+import timeit
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# telegram_bot يتحقق من المتغيرات عند الاستيراد؛ قيم وهمية تكفي هنا
+for _name in ("BOT_TOKEN", "OPENAI_API_KEY", "GOOGLE_SERVICE_ACCOUNT_JSON", "SHEET_ID"):
+    os.environ.setdefault(_name, "bench")
+
+from telegram_bot import (  # noqa: E402
+    LedgerMirror,
+    PeriodAggregator,
+    _parse_day,
+    _parse_expense_row,
+    new_ledger_index,
+    report_windows,
+)
+
+STATUS_PERIODS = ["today", "last_7_days", "this_month", "last_month", "this_year"]
+
+
+class LegacyRecord:
+    """الصف قبل ExpenseRecord: كائن عادي بدون __slots__ أو intern."""
+
+    def __init__(self, day, amount, process, type_, item):
+        self.day = day
+        self.amount = amount
+        self.process = process
+        self.type = type_
+        self.item = item
+
+
+def legacy_parse_expense_row(row):
+    """النسخة القديمة (strptime لكل صف) للمقارنة فقط."""
+    if len(row) < 5:
+        return None
+    date_str = row[0].strip()
+    process = row[1].strip() if len(row) > 1 and row[1] else ""
+    type_ = row[2].strip() if len(row) > 2 and row[2] else ""
+    item = row[3].strip() if len(row) > 3 and row[3] else ""
+    amount_str = row[4].strip()
+    if not date_str or not amount_str:
+        return None
+    try:
+        day = datetime.strptime(date_str[:10], "%Y-%m-%d").toordinal()
+        amount = float(str(amount_str).replace(",", ""))
+    except Exception:
+        return None
+    return LegacyRecord(day, amount, process, type_, item)
+
+
+def legacy_index(rows):
+    records = (legacy_parse_expense_row(r) for r in rows[1:])
+    return PeriodAggregator.from_expenses(e for e in records if e)
+
+
+def reference_summarize(records, start_date, end_date):
+    """مجموع مباشر صفاً صفاً (المرجع الذي يجب أن يطابقه الفهرس)."""
+    income = expense = net = 0.0
+    for e in records:
+        if not (start_date.toordinal() <= e.day <= end_date.toordinal()):
+            continue
+        if e.process == "بيع":
+            income += e.amount
+            net += e.amount
+        else:
+            expense += e.amount
+            net -= e.amount
+    return round(income, 2), round(expense, 2), round(net, 2)
+
+
+def make_rows(count, seed=1):
+    rng = random.Random(seed)
+    start = date(2021, 1, 1)
+    rows = [["التاريخ", "العملية", "النوع", "البند", "المبلغ", "ملاحظات", "الشخص", "الرصيد"]]
+    for _ in range(count):
+        day = start + timedelta(days=rng.randint(0, 4 * 365))
+        rows.append(
+            [
+                day.isoformat(),
+                rng.choice(["شراء", "بيع", "فاتورة", "راتب"]),
+                rng.choice(["علف", "منتجات", "عمال", "علاج", "كهرباء"]),
+                rng.choice(["علف برسيم", "غنم حري", "شعير", "راتب العامل"]),
+                str(rng.randint(10, 5000)),
+                "",
+                "خالد",
+                "",
+            ]
+        )
+    return rows
+
+
+class _Sheet:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def get_all_values(self):
+        # نسخة جديدة من النصوص في كل مرة كما ترجعها gspread
+        return [[str(v) + "" for v in row] for row in self.rows]
+
+
+def held_mb(build):
+    """الذاكرة التي يبقى يحجزها ناتج build() بعد انتهائه (بالميغابايت)."""
+    _parse_day.cache_clear()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        held = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del result
+    return held / 1e6
+
+
+def rebuild(mirror, windows):
+    """ما يحدث بعد أي تغيير في الدفتر: فهرس جديد من الصفوف ثم تقرير /status."""
+    _parse_day.cache_clear()
+    mirror._agg = None
+    return mirror.summarize_windows(windows, max_age=float("inf"))
+
+
+def main():
+    number = 5
+    windows = report_windows(STATUS_PERIODS, date(2023, 6, 15))
+    print(f"{'rows':>7}{'legacy build ms':>17}{'mirror build ms':>17}{'/status ms':>12}")
+    memory = []
+    for count in (5_000, 20_000, 50_000):
+        rows = make_rows(count)
+        mirror = LedgerMirror(lambda: _Sheet(rows))
+        mirror.ensure_fresh(max_age=0)
+
+        records = [e for e in (legacy_parse_expense_row(r) for r in rows[1:]) if e]
+        expected = {name: reference_summarize(records, *bounds) for name, bounds in windows.items()}
+        assert rebuild(mirror, windows) == expected
+        assert legacy_index(rows).summarize_windows(windows) == expected
+
+        t_legacy = timeit.timeit(
+            lambda: legacy_index(rows).summarize_windows(windows), number=number
+        )
+        t_mirror = timeit.timeit(lambda: rebuild(mirror, windows), number=number)
+        t_status = timeit.timeit(
+            lambda: mirror.summarize_windows(windows, max_age=float("inf")), number=number
+        )
+        print(
+            f"{count:>7}"
+            f"{t_legacy / number * 1000:>17.1f}{t_mirror / number * 1000:>17.1f}"
+            f"{t_status / number * 1000:>12.3f}"
+        )
+
+        data = rows[1:]
+        memory.append(
+            (
+                count,
+                held_mb(lambda: [e for e in map(legacy_parse_expense_row, data) if e]),
+                held_mb(lambda: [e for e in map(_parse_expense_row, data) if e]),
+                held_mb(lambda: legacy_index(rows)),
+                held_mb(lambda: new_ledger_index(data)),
+            )
+        )
+
+    print()
+    print(f"{'rows':>7}{'legacy rec MB':>15}{'record MB':>11}{'legacy idx MB':>15}{'mirror idx MB':>15}")
+    for count, legacy_rec, rec, legacy_idx, mirror_idx in memory:
+        print(f"{count:>7}{legacy_rec:>15.2f}{rec:>11.2f}{legacy_idx:>15.2f}{mirror_idx:>15.2f}")
+
+
+if __name__ == "__main__":
+    main()
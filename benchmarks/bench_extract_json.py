@@ -0,0 +1,80 @@
+"""Micro-benchmark for extract_json_from_raw.
+
+Compares the single-pass scanner in telegram_bot.py with the old
+suffix-truncation loop on recorded RAW_OPENAI_RESPONSE shapes (plain JSON,
+code fences, prose around the object, several objects).
+
+Run from the repo root:  python benchmarks/bench_extract_json.py
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# telegram_bot يتحقق من المتغيرات عند الاستيراد؛ قيم وهمية تكفي هنا
+for _name in ("BOT_TOKEN", "OPENAI_API_KEY", "GOOGLE_SERVICE_ACCOUNT_JSON", "SHEET_ID"):
+    os.environ.setdefault(_name, "bench")
+
+from telegram_bot import extract_json_from_raw  # noqa: E402
+
+
+def legacy_extract_json_from_raw(raw_text):
+    """النسخة القديمة (O(n²)) للمقارنة فقط."""
+    try:
+        return json.loads(raw_text)
+    except Exception:
+        pass
+    start = raw_text.find("{")
+    if start == -1:
+        raise ValueError("no JSON object found in response")
+    for end in range(len(raw_text) - 1, start, -1):
+        try:
+            return json.loads(raw_text[start : end + 1])
+        except Exception:
+            continue
+    raise ValueError("no parseable JSON found")
+
+
+_INTENT = {
+    "intent": "expense_create",
+    "date": "2025-01-14",
+    "process": "شراء",
+    "type": "علف",
+    "item": "علف برسيم",
+    "amount": 1000,
+    "note": None,
+    "query_period": None,
+    "query_process": None,
+    "query_type": None,
+    "query_item": None,
+    "livestock_entries": [],
+    "livestock_status_target": False,
+}
+_JSON = json.dumps(_INTENT, ensure_ascii=False, indent=2)
+
+SAMPLES = {
+    "plain": _JSON,
+    "fenced": "```json\n" + _JSON + "\n```",
+    "prose": "بناءً على رسالتك، هذا هو التحليل:\n" + _JSON + "\nأتمنى أن يكون هذا مفيداً. " * 5,
+    "multiple": '{"draft": true}\n' + _JSON + "\n" + '{"explanation": "done"}',
+    "long_tail": _JSON + "\n" + ("ملاحظة إضافية بدون JSON. " * 200),
+}
+
+
+def main():
+    number = 200
+    print(f"{'sample':<12}{'len':>7}{'legacy (ms)':>14}{'scanner (ms)':>14}")
+    for name, raw in SAMPLES.items():
+        assert extract_json_from_raw(raw)["intent"] == "expense_create", name
+        legacy = timeit.timeit(lambda: legacy_extract_json_from_raw(raw), number=number)
+        current = timeit.timeit(lambda: extract_json_from_raw(raw), number=number)
+        print(
+            f"{name:<12}{len(raw):>7}"
+            f"{legacy / number * 1000:>14.3f}{current / number * 1000:>14.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,15 +2,36 @@
 import os
 import re
 import json
+import time
+import bisect
+import copy
+import array
+import hashlib
+import functools
+import sys
+import random
+import atexit
+import signal
+import sqlite3
 import threading
 import http.server
-import socketserver
-from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import List, Optional, TypedDict
+
+try:
+    import numpy as np
+except ImportError:  # اختياري: فقط لـ LEDGER_BACKEND=numpy
+    np = None
 
 import gspread
+import google.auth.exceptions
+import google.auth.transport.requests
 from google.oauth2.service_account import Credentials
+from telegram import ChatAction, Update
 from telegram.ext import Updater, MessageHandler, Filters, CommandHandler
-from openai import OpenAI
+from openai import OpenAI, BadRequestError
 
 # ================== ENV ==================
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
@@ -34,103 +55,597 @@ USER_NAMES = {
     6894180427: "حمد",
 }
 
-# نخزن آخر رسالة تنتظر تأكيد لكل مستخدم
-# { user_id: {"text": str, "ai": dict} }
-PENDING_MESSAGES = {}
+# ================== METRICS ==================
+# حدود مدرجات زمن التنفيذ (ثواني)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """مدرج تراكمي بسيط بصيغة Prometheus (عدد لكل حد + المجموع + العدد)."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._counts = [0] * len(buckets)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._sum += seconds
+            self._count += 1
+            i = bisect.bisect_left(self.buckets, seconds)
+            if i < len(self._counts):
+                self._counts[i] += 1
+
+    def render(self, name, labels):
+        with self._lock:
+            counts, total, count = list(self._counts), self._sum, self._count
+        lines = []
+        cumulative = 0
+        for le, n in zip(self.buckets, counts):
+            cumulative += n
+            lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {count}')
+        lines.append(f"{name}_sum{{{labels}}} {total}")
+        lines.append(f"{name}_count{{{labels}}} {count}")
+        return lines
+
+
+# llm: نداء OpenAI، sheets_read/sheets_write: نداءات Google Sheets، e2e: رسالة كاملة
+LATENCY = {op: Histogram() for op in ("llm", "sheets_read", "sheets_write", "e2e")}
+
+# آخر نجاح وآخر خطأ وعدد الأخطاء المتتالية لكل خدمة خارجية
+DEPENDENCIES = ("sheets", "openai", "journal")
+DEPENDENCY_STATE = {
+    dep: {"last_ok": 0.0, "last_error_at": 0.0, "last_error": "", "failures": 0}
+    for dep in DEPENDENCIES
+}
+_DEPENDENCY_LOCK = threading.Lock()
+# الخدمة معطلة فقط بعد عدة أخطاء متتالية آخرها حديث (خطأ واحد على بوت هادئ لا يكفي)
+HEALTH_FAILURE_THRESHOLD = int(os.environ.get("HEALTH_FAILURE_THRESHOLD", "3"))
+HEALTH_ERROR_WINDOW = int(os.environ.get("HEALTH_ERROR_WINDOW", "300"))
+
+
+def record_dependency(dep, error=None):
+    with _DEPENDENCY_LOCK:
+        state = DEPENDENCY_STATE[dep]
+        if error is None:
+            state["last_ok"] = time.time()
+            state["failures"] = 0
+        else:
+            state["last_error_at"] = time.time()
+            state["last_error"] = repr(error)
+            state["failures"] += 1
+
+
+def _state_up(state, now) -> bool:
+    return not (
+        state["failures"] >= HEALTH_FAILURE_THRESHOLD
+        and now - state["last_error_at"] < HEALTH_ERROR_WINDOW
+    )
+
+
+def dependency_up(dep) -> bool:
+    """سليمة إلا إذا فشلت HEALTH_FAILURE_THRESHOLD مرات متتالية خلال HEALTH_ERROR_WINDOW."""
+    with _DEPENDENCY_LOCK:
+        return _state_up(DEPENDENCY_STATE[dep], time.time())
 
 
 # ================== SHEETS HELPERS ==================
+SHEETS_SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive",
+]
+LIVESTOCK_SHEET_TITLE = "المواشي - إجمالي"
+LIVESTOCK_HEADER = ["نوع الحيوان", "السلالة", "العدد الحالي"]
+META_SHEET_TITLE = "Azba Meta"
+
+# نجدد التوكن قبل انتهائه بهذه المدة (ثواني) حتى لا يدفع أي طلب ثمن التجديد
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_REFRESH_INTERVAL = 60
+SHEETS_TIMEOUT = float(os.environ.get("SHEETS_TIMEOUT", "20"))
+
+# عميل gspread واحد لكل العملية + كاش لمقابض التبويبات حسب العنوان
+# worksheets: { title (أو None للورقة الأولى): Worksheet }
+_GS_LOCK = threading.RLock()
+_GS_STATE = {
+    "creds": None,
+    "client": None,
+    "spreadsheet": None,
+    "worksheets": {},
+}
+
+
+def _get_credentials():
+    with _GS_LOCK:
+        if _GS_STATE["creds"] is None:
+            info = json.loads(GOOGLE_SERVICE_ACCOUNT_JSON)
+            _GS_STATE["creds"] = Credentials.from_service_account_info(
+                info, scopes=SHEETS_SCOPES
+            )
+        return _GS_STATE["creds"]
+
+
 def _get_gspread_client():
-    info = json.loads(GOOGLE_SERVICE_ACCOUNT_JSON)
-    scopes = [
-        "https://www.googleapis.com/auth/spreadsheets",
-        "https://www.googleapis.com/auth/drive",
-    ]
-    creds = Credentials.from_service_account_info(info, scopes=scopes)
-    client_gs = gspread.authorize(creds)
-    return client_gs
+    with _GS_LOCK:
+        if _GS_STATE["client"] is None:
+            client_gs = gspread.authorize(_get_credentials())
+            client_gs.set_timeout(SHEETS_TIMEOUT)
+            _GS_STATE["client"] = client_gs
+        return _GS_STATE["client"]
+
+
+def _get_spreadsheet():
+    with _GS_LOCK:
+        if _GS_STATE["spreadsheet"] is None:
+            _GS_STATE["spreadsheet"] = _get_gspread_client().open_by_key(SHEET_ID)
+        return _GS_STATE["spreadsheet"]
+
+
+def _get_worksheet(title, cols=3, header=None):
+    """نرجع مقبض التبويب من الكاش، أو نفتحه (وننشئه إذا غير موجود) أول مرة."""
+    with _GS_LOCK:
+        ws = _GS_STATE["worksheets"].get(title)
+        if ws is not None:
+            return ws
+
+        sh = _get_spreadsheet()
+        if title is None:
+            ws = sh.sheet1
+        else:
+            try:
+                ws = sh.worksheet(title)
+            except gspread.WorksheetNotFound:
+                ws = sh.add_worksheet(title=title, rows=1000, cols=cols)
+                if header:
+                    ws.append_row(header, value_input_option="USER_ENTERED")
+
+        _GS_STATE["worksheets"][title] = ws
+        return ws
+
+
+def invalidate_sheets_cache(reset_client=False):
+    """ننسى مقابض التبويبات (ومع reset_client ننسى العميل والصلاحيات أيضاً)."""
+    with _GS_LOCK:
+        _GS_STATE["worksheets"] = {}
+        _GS_STATE["spreadsheet"] = None
+        if reset_client:
+            _GS_STATE["client"] = None
+            _GS_STATE["creds"] = None
+
+
+def _is_auth_error(e) -> bool:
+    if isinstance(e, google.auth.exceptions.GoogleAuthError):
+        return True
+    if isinstance(e, gspread.exceptions.APIError):
+        return e.code in (401, 403)
+    return False
+
+
+def _is_stale_worksheet_error(e) -> bool:
+    if isinstance(e, gspread.WorksheetNotFound):
+        return True
+    if isinstance(e, gspread.exceptions.APIError):
+        return e.code == 400 and "Unable to parse range" in str(e)
+    return False
+
+
+# حدود Google Sheets لكل دقيقة (قراءة وكتابة منفصلتان)
+SHEETS_READS_PER_MINUTE = int(os.environ.get("SHEETS_READS_PER_MINUTE", "60"))
+SHEETS_WRITES_PER_MINUTE = int(os.environ.get("SHEETS_WRITES_PER_MINUTE", "60"))
+SHEETS_BURST = 10
+# توكنات نحجزها لطلبات المستخدم فلا تستهلكها المزامنة في الخلفية
+SHEETS_INTERACTIVE_RESERVE = 2
+SHEETS_MAX_RETRIES = int(os.environ.get("SHEETS_MAX_RETRIES", "4"))
+SHEETS_RETRY_BASE = 1.0
+SHEETS_RETRY_MAX = 32.0
+
+# نداءات القراءة حسب اسم الدالة؛ أي نداء آخر يُحسب كتابة
+_SHEETS_READ_CALLS = {
+    "get_all_values",
+    "get",
+    "get_values",
+    "col_values",
+    "row_values",
+    "get_lastUpdateTime",
+}
+# مقابض التبويبات من الكاش غالباً، لا نحسبها على الحصة
+_SHEETS_UNMETERED_CALLS = {"_get_worksheet"}
+
+SHEETS_STATS = {
+    "read_calls": 0,
+    "write_calls": 0,
+    "retries": 0,
+    "throttle_waits": 0,
+    "throttle_wait_seconds": 0.0,
+    "errors": 0,
+}
+_SHEETS_STATS_LOCK = threading.Lock()
+_SHEETS_CONTEXT = threading.local()
+
+
+def _count_sheets(key, amount=1):
+    with _SHEETS_STATS_LOCK:
+        SHEETS_STATS[key] += amount
+
+
+class TokenBucket:
+    """محدد معدل بسيط: rate توكن في الدقيقة وسعة burst.
+
+    الطلبات التفاعلية (رسالة أو أمر من المستخدم) لها الأولوية: طلبات الخلفية
+    تنتظر ما دام هناك طلب تفاعلي ينتظر، ولا تنزل بالرصيد تحت reserve.
+    """
+
+    def __init__(self, per_minute, burst, reserve):
+        self.rate = per_minute / 60.0
+        self.capacity = float(max(burst, reserve + 1))
+        self.reserve = reserve
+        self._tokens = self.capacity
+        self._stamp = time.monotonic()
+        self._interactive_waiting = 0
+        self._cond = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def acquire(self, background=False) -> float:
+        """ننتظر توكن؛ نرجع مدة الانتظار بالثواني."""
+        need = 1 + (self.reserve if background else 0)
+        started = time.monotonic()
+        with self._cond:
+            if not background:
+                self._interactive_waiting += 1
+            try:
+                while True:
+                    self._refill()
+                    blocked = background and self._interactive_waiting
+                    if self._tokens >= need and not blocked:
+                        self._tokens -= 1
+                        return time.monotonic() - started
+                    if blocked:
+                        self._cond.wait(0.05)
+                    else:
+                        self._cond.wait((need - self._tokens) / self.rate)
+            finally:
+                if not background:
+                    self._interactive_waiting -= 1
+                    self._cond.notify_all()
+
+
+SHEETS_READ_BUCKET = TokenBucket(SHEETS_READS_PER_MINUTE, SHEETS_BURST, SHEETS_INTERACTIVE_RESERVE)
+SHEETS_WRITE_BUCKET = TokenBucket(SHEETS_WRITES_PER_MINUTE, SHEETS_BURST, SHEETS_INTERACTIVE_RESERVE)
+
+
+class background_sheets:
+    """نداءات Sheets داخل هذا السياق (مزامنة، كاتب السجل...) أولويتها أقل من المستخدم."""
+
+    def __enter__(self):
+        self._prev = getattr(_SHEETS_CONTEXT, "background", False)
+        _SHEETS_CONTEXT.background = True
+        return self
+
+    def __exit__(self, *exc):
+        _SHEETS_CONTEXT.background = self._prev
+        return False
+
+
+def _is_quota_error(e) -> bool:
+    return isinstance(e, gspread.exceptions.APIError) and e.code == 429
+
+
+def _is_retryable_error(e, is_read) -> bool:
+    """429 دائماً (الطلب رُفض قبل التنفيذ)؛ 5xx ومشاكل الشبكة للقراءة فقط
+    لأن كتابة مثل append قد تكون نُفذت فعلاً قبل الخطأ. الكتابة الفاشلة يعيدها
+    سجل الكتابة (WriteJournal) بعد أن يتحقق من الورقة أنها لم تصل."""
+    if _is_quota_error(e):
+        return True
+    if not is_read:
+        return False
+    if isinstance(e, gspread.exceptions.APIError):
+        return e.code >= 500
+    # أخطاء requests (انقطاع، مهلة) كلها من OSError
+    return isinstance(e, OSError)
+
+
+def _sheets_call(fn, *args, **kwargs):
+    """بوابة كل نداءات Google Sheets: حد المعدل، إعادة المحاولة مع تراجع أُسّي
+    وعشوائي على 429/5xx، وإبطال الكاش عند أخطاء الصلاحيات أو تبويب محذوف."""
+    name = getattr(fn, "__name__", "")
+    is_read = name in _SHEETS_READ_CALLS
+    metered = name not in _SHEETS_UNMETERED_CALLS
+    background = getattr(_SHEETS_CONTEXT, "background", False)
+    bucket = SHEETS_READ_BUCKET if is_read else SHEETS_WRITE_BUCKET
+
+    attempt = 0
+    while True:
+        if metered:
+            waited = bucket.acquire(background)
+            if waited > 0.01:
+                _count_sheets("throttle_waits")
+                _count_sheets("throttle_wait_seconds", waited)
+            _count_sheets("read_calls" if is_read else "write_calls")
+        started = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+            if metered:
+                LATENCY["sheets_read" if is_read else "sheets_write"].observe(
+                    time.monotonic() - started
+                )
+                record_dependency("sheets")
+            return result
+        except Exception as e:
+            if _is_auth_error(e):
+                print("Sheets auth error, resetting client:", repr(e))
+                invalidate_sheets_cache(reset_client=True)
+            elif _is_stale_worksheet_error(e):
+                print("Sheets worksheet handle is stale, dropping cache:", repr(e))
+                invalidate_sheets_cache()
+            elif attempt < SHEETS_MAX_RETRIES and _is_retryable_error(e, is_read):
+                delay = random.uniform(0, min(SHEETS_RETRY_MAX, SHEETS_RETRY_BASE * 2 ** attempt))
+                attempt += 1
+                _count_sheets("retries")
+                print(f"Sheets {name} failed, retry {attempt} in {delay:.1f}s:", repr(e))
+                time.sleep(delay)
+                continue
+            _count_sheets("errors")
+            record_dependency("sheets", e)
+            raise
+
+
+def _refresh_token_if_needed():
+    with _GS_LOCK:
+        creds = _GS_STATE["creds"]
+    if creds is None:
+        return
+    expiry = creds.expiry
+    if (
+        creds.valid
+        and expiry is not None
+        and expiry - datetime.utcnow() > timedelta(seconds=TOKEN_REFRESH_MARGIN)
+    ):
+        return
+    creds.refresh(google.auth.transport.requests.Request())
+
+
+def start_token_refresher():
+    """خيط خلفي يجدد توكن حساب الخدمة قبل انتهائه."""
+
+    def loop():
+        while True:
+            try:
+                _get_credentials()
+                _refresh_token_if_needed()
+            except Exception as e:
+                print("ERROR refreshing Google token:", repr(e))
+            time.sleep(TOKEN_REFRESH_INTERVAL)
+
+    t = threading.Thread(target=loop, name="gs-token-refresher", daemon=True)
+    t.start()
+    return t
 
 
 def get_expense_sheet():
-    client_gs = _get_gspread_client()
-    return client_gs.open_by_key(SHEET_ID).sheet1
+    return _sheets_call(_get_worksheet, None)
 
 
 def get_livestock_summary_sheet():
-    client_gs = _get_gspread_client()
-    sh = client_gs.open_by_key(SHEET_ID)
-    try:
-        ws = sh.worksheet("المواشي - إجمالي")
-    except gspread.WorksheetNotFound:
-        ws = sh.add_worksheet(title="المواشي - إجمالي", rows=1000, cols=3)
-        ws.append_row(
-            ["نوع الحيوان", "السلالة", "العدد الحالي"],
-            value_input_option="USER_ENTERED",
+    return _sheets_call(
+        _get_worksheet,
+        LIVESTOCK_SHEET_TITLE,
+        cols=3,
+        header=LIVESTOCK_HEADER,
+    )
+
+
+def _cell(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return {"userEnteredValue": {"stringValue": "" if value is None else str(value)}}
+    return {"userEnteredValue": {"numberValue": value}}
+
+
+def rewrite_worksheet(sheet, values):
+    """نمسح التبويب ونكتب كل الصفوف في طلب batchUpdate واحد (ذري من جهة Google)."""
+    requests = []
+    if len(values) > sheet.row_count:
+        requests.append(
+            {
+                "appendDimension": {
+                    "sheetId": sheet.id,
+                    "dimension": "ROWS",
+                    "length": len(values) - sheet.row_count,
+                }
+            }
         )
-    return ws
+    requests.append(
+        {"updateCells": {"range": {"sheetId": sheet.id}, "fields": "userEnteredValue"}}
+    )
+    requests.append(
+        {
+            "updateCells": {
+                "start": {"sheetId": sheet.id, "rowIndex": 0, "columnIndex": 0},
+                "rows": [{"values": [_cell(v) for v in row]} for row in values],
+                "fields": "userEnteredValue",
+            }
+        }
+    )
+    return _sheets_call(_get_spreadsheet().batch_update, {"requests": requests})
 
 
 def get_meta_sheet():
     """ورقة داخلية لتخزين ميتا المواشي لكل صف في Azba Expenses."""
-    client_gs = _get_gspread_client()
-    sh = client_gs.open_by_key(SHEET_ID)
-    try:
-        ws = sh.worksheet("Azba Meta")
-    except gspread.WorksheetNotFound:
-        ws = sh.add_worksheet(title="Azba Meta", rows=1000, cols=4)
-        ws.append_row(
-            ["Row", "AnimalType", "Breed", "Delta"],
-            value_input_option="USER_ENTERED",
-        )
-    return ws
+    return _sheets_call(
+        _get_worksheet,
+        META_SHEET_TITLE,
+        cols=4,
+        header=["Row", "AnimalType", "Breed", "Delta"],
+    )
 
 
-def log_livestock_meta(row_index: int, animal_type: str, breed: str, delta: int):
-    """نسجل ارتباط صف Azba Expenses مع تعديل المواشي في ورقة Azba Meta."""
-    try:
-        meta_sheet = get_meta_sheet()
-        meta_sheet.append_row(
-            [row_index, animal_type or "", breed or "", delta],
-            value_input_option="USER_ENTERED",
-        )
-    except Exception as e:
-        print("ERROR logging livestock meta:", repr(e))
+def _range_start_row(a1_range):
+    """أول رقم صف في مدى مثل 'Azba Meta'!A5:D7، أو None."""
+    m = re.search(r"![A-Z]+(\d+)", a1_range or "")
+    return int(m.group(1)) if m else None
+
+
+class MetaIndex:
+    """فهرس في الذاكرة لورقة Azba Meta.
+
+    by_row: رقم صف Azba Expenses → قائمة [صف الميتا, animal_type, breed, delta].
+    يُحمّل مرة واحدة عند أول حاجة ويُحدّث مع كل إضافة أو حذف من البوت.
+    """
+
+    def __init__(self, get_sheet):
+        self._get_sheet = get_sheet
+        self._lock = threading.RLock()
+        self._by_row = None
+        self._row_count = 0
+
+    def _ensure_loaded(self):
+        if self._by_row is not None:
+            return
+        rows = _sheets_call(self._get_sheet().get_all_values)
+        by_row = {}
+        for idx, row in enumerate(rows[1:], start=2):
+            if not row:
+                continue
+            try:
+                rid = int((row[0] or "").strip())
+            except Exception:
+                continue
+            try:
+                delta = int(float(row[3])) if len(row) > 3 and row[3] else 0
+            except Exception:
+                delta = 0
+            by_row.setdefault(rid, []).append(
+                [idx, row[1] if len(row) > 1 else "", row[2] if len(row) > 2 else "", delta]
+            )
+        self._by_row = by_row
+        self._row_count = len(rows)
+
+    def invalidate(self):
+        with self._lock:
+            self._by_row = None
+
+    def reload(self):
+        with self._lock:
+            self._by_row = None
+            self._ensure_loaded()
+
+    def check_changes(self):
+        """فحص رخيص: عمود رقم الصف فقط؛ أي اختلاف عن الفهرس → إعادة تحميل."""
+        with self._lock:
+            if self._by_row is None:
+                self._ensure_loaded()
+                return
+            ids = _trim_row([str(v) for v in _sheets_call(self._get_sheet().col_values, 1)])
+            expected = {idx: str(rid) for rid, metas in self._by_row.items() for idx, *_ in metas}
+            if len(ids) != self._row_count or any(
+                ids[idx - 1].strip() != rid for idx, rid in expected.items() if idx <= len(ids)
+            ):
+                self.reload()
+
+    def export(self):
+        """{"row_count", "entries": [[صف الدفتر, صف الميتا, animal, breed, delta]]} أو None."""
+        with self._lock:
+            if self._by_row is None:
+                return None
+            entries = [[rid] + list(m) for rid, metas in self._by_row.items() for m in metas]
+            return {"row_count": self._row_count, "entries": entries}
+
+    def restore(self, data):
+        with self._lock:
+            by_row = {}
+            for rid, idx, animal, breed, delta in data["entries"]:
+                by_row.setdefault(rid, []).append([idx, animal, breed, delta])
+            self._by_row = by_row
+            self._row_count = data["row_count"]
+
+    def add_many(self, items):
+        """items: قائمة (رقم صف Azba Expenses, entries)؛ كلها في append_rows واحد."""
+        flat = [(row_index, e) for row_index, entries in items for e in entries]
+        if not flat:
+            return
+        with self._lock:
+            self._ensure_loaded()
+            values = [[row_index, a or "", b or "", d] for row_index, (a, b, d) in flat]
+            resp = _sheets_call(
+                self._get_sheet().append_rows, values, value_input_option="USER_ENTERED"
+            )
+            start = _range_start_row((resp or {}).get("updates", {}).get("updatedRange"))
+            if start is None:
+                start = self._row_count + 1
+            for offset, (row_index, (a, b, d)) in enumerate(flat):
+                self._by_row.setdefault(row_index, []).append([start + offset, a or "", b or "", d])
+            self._row_count = max(self._row_count, start + len(flat) - 1)
+
+    def entries_for(self, row_index):
+        with self._lock:
+            self._ensure_loaded()
+            return [list(m) for m in self._by_row.get(row_index, [])]
+
+    def delete(self, meta_rows):
+        """نحذف عدة صفوف من Azba Meta في batchUpdate واحد (من الأسفل للأعلى)."""
+        meta_rows = sorted(set(meta_rows), reverse=True)
+        if not meta_rows:
+            return
+        with self._lock:
+            self._ensure_loaded()
+            sheet_id = self._get_sheet().id
+            requests = [
+                {
+                    "deleteDimension": {
+                        "range": {
+                            "sheetId": sheet_id,
+                            "dimension": "ROWS",
+                            "startIndex": r - 1,
+                            "endIndex": r,
+                        }
+                    }
+                }
+                for r in meta_rows
+            ]
+            _sheets_call(_get_spreadsheet().batch_update, {"requests": requests})
+
+            deleted = set(meta_rows)
+            for rid in list(self._by_row):
+                kept = []
+                for m in self._by_row[rid]:
+                    if m[0] in deleted:
+                        continue
+                    m[0] -= sum(1 for r in meta_rows if r < m[0])
+                    kept.append(m)
+                if kept:
+                    self._by_row[rid] = kept
+                else:
+                    del self._by_row[rid]
+            self._row_count -= len(meta_rows)
+
+
+META = MetaIndex(get_meta_sheet)
 
 
 def fetch_livestock_meta_for_row(row_index: int):
-    """نرجع (meta_row_index_in_meta_sheet, meta_dict) لصف معيّن أو (None, None)."""
+    """نرجع كل [(meta_row_index_in_meta_sheet, meta_dict)] المرتبطة بصف معيّن."""
     try:
-        meta_sheet = get_meta_sheet()
-        rows = meta_sheet.get_all_values()
+        entries = META.entries_for(row_index)
     except Exception as e:
         print("ERROR reading Azba Meta:", repr(e))
-        return None, None
-
-    for idx, row in enumerate(rows[1:], start=2):
-        if not row:
-            continue
-        row_id_str = (row[0] or "").strip()
-        try:
-            rid = int(row_id_str)
-        except Exception:
-            continue
-        if rid == row_index:
-            meta = {
-                "animal_type": row[1] if len(row) > 1 else "",
-                "breed": row[2] if len(row) > 2 else "",
-                "delta": int(float(row[3])) if len(row) > 3 and row[3] else 0,
-            }
-            return idx, meta
-
-    return None, None
+        return []
+    return [
+        (idx, {"animal_type": animal, "breed": breed, "delta": delta})
+        for idx, animal, breed, delta in entries
+    ]
 
 
-def delete_meta_row(meta_row_index: int):
+def delete_meta_rows(meta_row_indexes):
     try:
-        meta_sheet = get_meta_sheet()
-        meta_sheet.delete_rows(meta_row_index)
+        META.delete(meta_row_indexes)
     except Exception as e:
-        print("ERROR deleting meta row:", repr(e))
+        print("ERROR deleting meta rows:", repr(e))
+        META.invalidate()
 
 
 def authorized(update):
@@ -138,6 +653,42 @@ def authorized(update):
 
 
 # ================== AI HELPERS ==================
+def _json_object_spans(text):
+    """مرور واحد على النص: نرجع كل كائنات {...} المتوازنة كشجرة.
+
+    نتجاهل الأقواس داخل النصوص "..." (مع \\ للهروب). النتيجة قائمة
+    (start, end, children) للكائنات العليا فقط، والأقواس غير المغلقة
+    (مثل { في الكلام قبل JSON) لا تمنع التقاط ما بداخلها.
+    """
+    stack = []  # [(start, children)]
+    roots = []
+    in_str = False
+    esc = False
+    for i, ch in enumerate(text):
+        if in_str:
+            if esc:
+                esc = False
+            elif ch == "\\":
+                esc = True
+            elif ch == '"':
+                in_str = False
+            continue
+        if ch == "{":
+            stack.append((i, []))
+        elif ch == "}" and stack:
+            start, children = stack.pop()
+            node = (start, i + 1, children)
+            (stack[-1][1] if stack else roots).append(node)
+        elif ch == '"' and stack:
+            in_str = True
+
+    # الكائنات المغلقة داخل قوس لم يُغلق تصبح عليا
+    for _, children in stack:
+        roots.extend(children)
+    roots.sort(key=lambda n: n[0])
+    return roots
+
+
 def extract_json_from_raw(raw_text):
     if not isinstance(raw_text, str):
         raw_text = str(raw_text)
@@ -147,86 +698,267 @@ def extract_json_from_raw(raw_text):
     except Exception:
         pass
 
-    start = raw_text.find("{")
-    if start == -1:
+    roots = _json_object_spans(raw_text)
+    if not roots:
         raise ValueError("no JSON object found in response")
 
-    for end in range(len(raw_text) - 1, start, -1):
-        candidate = raw_text[start : end + 1]
+    # نحلل الكائنات العليا، وإذا فشل كائن ننزل لأبنائه فقط
+    parsed = []
+    pending = list(roots)
+    while pending:
+        start, end, children = pending.pop(0)
         try:
-            return json.loads(candidate)
+            value = json.loads(raw_text[start:end])
         except Exception:
+            pending[0:0] = children
             continue
+        if isinstance(value, dict) and "intent" in value:
+            return value
+        parsed.append(value)
+
+    if not parsed:
+        raise ValueError("no parseable JSON found")
+    for value in parsed:
+        if isinstance(value, dict):
+            return value
+    return parsed[0]
+
+
+# ثابت لكل الطلبات (حتى يستفيد من prompt caching عند المزود)؛ فقط التاريخ والرسالة يتغيران
+_PROMPT_HEADER = (
+    "أنت مساعد محاسبي ومساعد لإدارة المواشي في مزرعة.\n"
+    "اقرأ رسالة المستخدم وحدد نيته بدقة، ثم أعد فقط JSON صالح بدون أي تعليق.\n\n"
+)
+_PROMPT_SCHEMA = (
+    "السكيم:\n"
+    "{\n"
+    '  "intent": "expense_create" | "financial_query" | '
+    '            "livestock_baseline" | "livestock_change" | '
+    '            "livestock_status" | "other",\n'
+    '\n'
+    '  "date": "YYYY-MM-DD" أو null,\n'
+    '\n'
+    '  "process": "شراء"|"بيع"|"فاتورة"|"راتب"|"أخرى"|null,\n'
+    '  "type": "علف"|"منتجات"|"عمال"|"علاج"|"كهرباء"|"ماء"|"اخرى"|null,\n'
+    '  "item": نص قصير أو null,\n'
+    '  "amount": رقم موجب أو null,\n'
+    '  "note": نص أو null,\n'
+    '\n'
+    '  "query_period": "today"|"yesterday"|"this_week"|"last_7_days"|"this_month"|"last_month"|"this_year"|"all_time"|null,\n'
+    '  "query_process": مثل process أو null,\n'
+    '  "query_type": مثل type أو null,\n'
+    '  "query_item": نص أو null,\n'
+    '\n'
+    '  "livestock_entries": [\n'
+    "     {\n"
+    '       "animal_type": "غنم"|"أبقار"|"ثور"|"جمال"|"ماعز"|"اخرى",\n'
+    '       "breed": "حري"|"صلالي"|"صومالي"|"سوري"|"اضاحي"|"اخرى",\n'
+    '       "count": عدد صحيح موجب,\n'
+    '       "movement": "إجمالي"|"إضافة"|"نقص"|"بيع"|"نفوق"|"مواليد"\n'
+    "     }\n"
+    "  ] أو [],\n"
+    '\n'
+    '  "livestock_status_target": true|false\n'
+    "}\n\n"
+)
+_PROMPT_RULES = (
+    "اختر intent حسب معنى الرسالة:\n"
+    "- إذا كانت عملية مالية للحفظ في الدفتر (شراء، بيع، فاتورة، راتب...) → intent = \"expense_create\".\n"
+    "- إذا كان سؤال عن مبالغ (كم صرفت، كم ربحت، كم دخلت من بيع شيء...) → intent = \"financial_query\".\n"
+    "- إذا كانت رسالة حصر مثل: \"سجل العدد الكلي للمواشي\" → intent = \"livestock_baseline\" "
+    "وملّئ livestock_entries مع movement = \"إجمالي\".\n"
+    "- إذا كانت بيع/شراء/نفوق/مواليد لعدد محدد من المواشي بدون التركيز على المبلغ "
+    "أو مع مبلغ لكن التركيز على تعديل الأعداد → اجعل intent = \"expense_create\" إذا كان هناك مبلغ واضح، "
+    "مع تعبئة الحقول المالية، واملأ livestock_entries لتعديل الأعداد.\n"
+    "- إذا طلب المستخدم كشف أو حالة المواشي (مثل: اعطني كشف المواشي، كم عندي مواشي) "
+    "→ intent = \"livestock_status\".\n"
+    "- إذا كانت الرسالة تحتوي على تغيير في أعداد المواشي فقط بدون أي مبلغ واضح (مثل: نفق 2 حري) "
+    "→ intent = \"livestock_change\" واملأ livestock_entries بما يناسب.\n"
+    "- إذا كانت الرسالة لا تنطبق على ما سبق → intent = \"other\".\n\n"
+)
+# في وضع structured output السكيم يُرسل كـ JSON schema فلا نكرره في النص
+ANALYZE_INSTRUCTIONS = _PROMPT_HEADER + _PROMPT_RULES
+
+AI_MODEL = "gpt-4.1-mini"
+AI_TIMEOUT = float(os.environ.get("AI_TIMEOUT", "30"))
+AI_STRUCTURED_OUTPUT = os.environ.get("AI_STRUCTURED_OUTPUT", "1") != "0"
+
+INTENTS = [
+    "expense_create",
+    "financial_query",
+    "livestock_baseline",
+    "livestock_change",
+    "livestock_status",
+    "other",
+]
+PROCESSES = ["شراء", "بيع", "فاتورة", "راتب", "أخرى"]
+TYPES = ["علف", "منتجات", "عمال", "علاج", "كهرباء", "ماء", "اخرى"]
+QUERY_PERIODS = [
+    "today",
+    "yesterday",
+    "this_week",
+    "last_7_days",
+    "this_month",
+    "last_month",
+    "this_year",
+    "all_time",
+]
+ANIMAL_TYPES = ["غنم", "أبقار", "ثور", "جمال", "ماعز", "اخرى"]
+BREEDS = ["حري", "صلالي", "صومالي", "سوري", "اضاحي", "اخرى"]
+MOVEMENTS = ["إجمالي", "إضافة", "نقص", "بيع", "نفوق", "مواليد"]
+
+
+class LivestockEntry(TypedDict):
+    animal_type: Optional[str]
+    breed: Optional[str]
+    count: int
+    movement: Optional[str]
+
+
+class IntentData(TypedDict):
+    intent: str
+    date: Optional[str]
+    process: Optional[str]
+    type: Optional[str]
+    item: Optional[str]
+    amount: Optional[float]
+    note: Optional[str]
+    query_period: Optional[str]
+    query_process: Optional[str]
+    query_type: Optional[str]
+    query_item: Optional[str]
+    livestock_entries: List[LivestockEntry]
+    livestock_status_target: bool
+
+
+def _nullable(schema):
+    schema = dict(schema)
+    schema["type"] = [schema["type"], "null"]
+    if "enum" in schema:
+        schema["enum"] = schema["enum"] + [None]
+    return schema
+
+
+INTENT_JSON_SCHEMA = {
+    "type": "object",
+    "additionalProperties": False,
+    "required": list(IntentData.__annotations__),
+    "properties": {
+        "intent": {"type": "string", "enum": INTENTS},
+        "date": _nullable({"type": "string", "description": "YYYY-MM-DD"}),
+        "process": _nullable({"type": "string", "enum": PROCESSES}),
+        "type": _nullable({"type": "string", "enum": TYPES}),
+        "item": _nullable({"type": "string"}),
+        "amount": _nullable({"type": "number"}),
+        "note": _nullable({"type": "string"}),
+        "query_period": _nullable({"type": "string", "enum": QUERY_PERIODS}),
+        "query_process": _nullable({"type": "string", "enum": PROCESSES}),
+        "query_type": _nullable({"type": "string", "enum": TYPES}),
+        "query_item": _nullable({"type": "string"}),
+        "livestock_entries": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "additionalProperties": False,
+                "required": list(LivestockEntry.__annotations__),
+                "properties": {
+                    "animal_type": {"type": "string", "enum": ANIMAL_TYPES},
+                    "breed": {"type": "string", "enum": BREEDS},
+                    "count": {"type": "integer"},
+                    "movement": {"type": "string", "enum": MOVEMENTS},
+                },
+            },
+        },
+        "livestock_status_target": {"type": "boolean"},
+    },
+}
 
-    raise ValueError("no parseable JSON found")
 
+def validate_intent(data) -> IntentData:
+    """نتأكد أن رد الذكاء الاصطناعي يطابق IntentData.
 
-def analyze_with_ai(text):
-    """تحليل موحّد لكل شيء: عمليات مالية + استعلامات + مواشي."""
-    today = datetime.now().date().isoformat()
-    yesterday = (datetime.now().date() - timedelta(days=1)).isoformat()
-
-    system_instructions = (
-        "أنت مساعد محاسبي ومساعد لإدارة المواشي في مزرعة.\n"
-        "اقرأ رسالة المستخدم وحدد نيته بدقة، ثم أعد فقط JSON صالح بدون أي تعليق.\n\n"
-        "السكيم:\n"
-        "{\n"
-        '  "intent": "expense_create" | "financial_query" | '
-        '            "livestock_baseline" | "livestock_change" | '
-        '            "livestock_status" | "other",\n'
-        '\n'
-        '  "date": "YYYY-MM-DD" أو null,\n'
-        '\n'
-        '  "process": "شراء"|"بيع"|"فاتورة"|"راتب"|"أخرى"|null,\n'
-        '  "type": "علف"|"منتجات"|"عمال"|"علاج"|"كهرباء"|"ماء"|"اخرى"|null,\n'
-        '  "item": نص قصير أو null,\n'
-        '  "amount": رقم موجب أو null,\n'
-        '  "note": نص أو null,\n'
-        '\n'
-        '  "query_period": "today"|"yesterday"|"this_week"|"last_7_days"|"this_month"|"all_time"|null,\n'
-        '  "query_process": مثل process أو null,\n'
-        '  "query_type": مثل type أو null,\n'
-        '  "query_item": نص أو null,\n'
-        '\n'
-        '  "livestock_entries": [\n'
-        "     {\n"
-        '       "animal_type": "غنم"|"أبقار"|"ثور"|"جمال"|"ماعز"|"اخرى",\n'
-        '       "breed": "حري"|"صلالي"|"صومالي"|"سوري"|"اضاحي"|"اخرى",\n'
-        '       "count": عدد صحيح موجب,\n'
-        '       "movement": "إجمالي"|"إضافة"|"نقص"|"بيع"|"نفوق"|"مواليد"\n'
-        "     }\n"
-        "  ] أو [],\n"
-        '\n'
-        '  "livestock_status_target": true|false\n'
-        "}\n\n"
-        "اختر intent حسب معنى الرسالة:\n"
-        "- إذا كانت عملية مالية للحفظ في الدفتر (شراء، بيع، فاتورة، راتب...) → intent = \"expense_create\".\n"
-        "- إذا كان سؤال عن مبالغ (كم صرفت، كم ربحت، كم دخلت من بيع شيء...) → intent = \"financial_query\".\n"
-        "- إذا كانت رسالة حصر مثل: \"سجل العدد الكلي للمواشي\" → intent = \"livestock_baseline\" "
-        "وملّئ livestock_entries مع movement = \"إجمالي\".\n"
-        "- إذا كانت بيع/شراء/نفوق/مواليد لعدد محدد من المواشي بدون التركيز على المبلغ "
-        "أو مع مبلغ لكن التركيز على تعديل الأعداد → اجعل intent = \"expense_create\" إذا كان هناك مبلغ واضح، "
-        "مع تعبئة الحقول المالية، واملأ livestock_entries لتعديل الأعداد.\n"
-        "- إذا طلب المستخدم كشف أو حالة المواشي (مثل: اعطني كشف المواشي، كم عندي مواشي) "
-        "→ intent = \"livestock_status\".\n"
-        "- إذا كانت الرسالة تحتوي على تغيير في أعداد المواشي فقط بدون أي مبلغ واضح (مثل: نفق 2 حري) "
-        "→ intent = \"livestock_change\" واملأ livestock_entries بما يناسب.\n"
-        "- إذا كانت الرسالة لا تنطبق على ما سبق → intent = \"other\".\n\n"
-        f"لو قال اليوم أو لم يذكر تاريخ استخدم {today}, لو قال امس استخدم {yesterday}.\n"
-    )
+    intent غير معروف → ValueError. باقي الحقول (ومنها نوع الحيوان والسلالة
+    والحركة في كل بند مواشي): القيم خارج القوائم أو بنوع خاطئ تصبح null،
+    والبنود بدون عدد في livestock_entries تُحذف.
+    """
+    if not isinstance(data, dict):
+        raise ValueError(f"AI returned non-dict JSON: {type(data)}")
+    if data.get("intent") not in INTENTS:
+        raise ValueError(f"unknown intent: {data.get('intent')!r}")
+
+    def pick(key, allowed=None, kind=str):
+        value = data.get(key)
+        if value is None or not isinstance(value, kind) or isinstance(value, bool):
+            return None
+        if allowed is not None and value not in allowed:
+            return None
+        return value
+
+    def pick_amount():
+        # الوضع القديم قد يرجع المبلغ نصاً مثل "4,000"
+        value = data.get("amount")
+        if isinstance(value, bool):
+            return None
+        if isinstance(value, (int, float)):
+            return value
+        if isinstance(value, str):
+            try:
+                return float(value.strip().replace(",", ""))
+            except ValueError:
+                return None
+        return None
+
+    def pick_entry(e, key, allowed, default):
+        # غير موجود → القيمة الافتراضية، خارج القائمة → null
+        value = e.get(key)
+        if not value:
+            return default
+        return value if value in allowed else None
+
+    entries = []
+    for e in data.get("livestock_entries") or []:
+        if not isinstance(e, dict):
+            continue
+        count = _parse_count(e.get("count"))
+        if count is None:
+            continue
+        entries.append(
+            {
+                "animal_type": pick_entry(e, "animal_type", ANIMAL_TYPES, "اخرى"),
+                "breed": pick_entry(e, "breed", BREEDS, "اخرى"),
+                "count": count,
+                "movement": pick_entry(e, "movement", MOVEMENTS, ""),
+            }
+        )
 
-    user_block = json.dumps({"message": text}, ensure_ascii=False)
-    prompt = system_instructions + "\n\nUserMessage:\n" + user_block
+    return {
+        "intent": data["intent"],
+        "date": pick("date"),
+        "process": pick("process", PROCESSES),
+        "type": pick("type", TYPES),
+        "item": pick("item"),
+        "amount": pick_amount(),
+        "note": pick("note"),
+        "query_period": pick("query_period", QUERY_PERIODS),
+        "query_process": pick("query_process", PROCESSES),
+        "query_type": pick("query_type", TYPES),
+        "query_item": pick("query_item"),
+        "livestock_entries": entries,
+        "livestock_status_target": bool(data.get("livestock_status_target")),
+    }
+
+
+def _date_hint():
+    today = datetime.now().date()
+    yesterday = today - timedelta(days=1)
+    return (
+        f"لو قال اليوم أو لم يذكر تاريخ استخدم {today.isoformat()}, "
+        f"لو قال امس استخدم {yesterday.isoformat()}.\n"
+    )
 
-    try:
-        resp = openai_client.responses.create(
-            model="gpt-4.1-mini",
-            input=prompt,
-            max_output_tokens=400,
-        )
-    except Exception as e:
-        raise RuntimeError(f"OpenAI API call failed: {e}")
 
+def _response_text(resp):
+    """نص الرد من Responses API مهما كان شكل الكائن."""
     raw = getattr(resp, "output_text", None)
     if not raw:
         try:
@@ -259,13 +991,81 @@ def analyze_with_ai(text):
 
     if not raw:
         raw = str(resp)
+    return raw
+
+
+def _analyze_structured(text):
+    """تعليمات ثابتة + JSON schema صارم؛ نرسل فقط التاريخ والرسالة."""
+    user_block = _date_hint() + json.dumps({"message": text}, ensure_ascii=False)
+    resp = openai_client.responses.create(
+        model=AI_MODEL,
+        instructions=ANALYZE_INSTRUCTIONS,
+        input=user_block,
+        text={
+            "format": {
+                "type": "json_schema",
+                "name": "azba_intent",
+                "schema": INTENT_JSON_SCHEMA,
+                "strict": True,
+            }
+        },
+        prompt_cache_key="azba-intent",
+        max_output_tokens=400,
+        timeout=AI_TIMEOUT,
+    )
+    raw = _response_text(resp)
+    print("RAW_OPENAI_RESPONSE:", raw)
+    return json.loads(raw)
+
 
+def _analyze_legacy(text):
+    """البرومبت الكامل كنص واحد واستخراج JSON من الرد."""
+    user_block = json.dumps({"message": text}, ensure_ascii=False)
+    prompt = (
+        _PROMPT_HEADER
+        + _PROMPT_SCHEMA
+        + _PROMPT_RULES
+        + _date_hint()
+        + "\n\nUserMessage:\n"
+        + user_block
+    )
+    resp = openai_client.responses.create(
+        model=AI_MODEL,
+        input=prompt,
+        max_output_tokens=400,
+        timeout=AI_TIMEOUT,
+    )
+    raw = _response_text(resp)
     print("RAW_OPENAI_RESPONSE:", raw)
+    return extract_json_from_raw(raw)
 
-    data = extract_json_from_raw(raw)
-    if not isinstance(data, dict):
-        raise RuntimeError(f"AI returned non-dict JSON: {type(data)}")
-    return data
+
+def analyze_with_ai(text):
+    """تحليل موحّد لكل شيء: عمليات مالية + استعلامات + مواشي."""
+    started = time.monotonic()
+    try:
+        if AI_STRUCTURED_OUTPUT:
+            try:
+                data = _analyze_structured(text)
+            except BadRequestError as e:
+                # الموديل أو السكيم غير مدعوم → نرجع للبرومبت النصي
+                print("Structured output rejected, using legacy prompt:", repr(e))
+                data = _analyze_legacy(text)
+        else:
+            data = _analyze_legacy(text)
+    except ValueError:
+        raise
+    except Exception as e:
+        record_dependency("openai", e)
+        raise RuntimeError(f"OpenAI API call failed: {e}")
+    finally:
+        LATENCY["llm"].observe(time.monotonic() - started)
+    record_dependency("openai")
+
+    try:
+        return validate_intent(data)
+    except ValueError as e:
+        raise RuntimeError(str(e))
 
 
 def has_explicit_date(text: str) -> bool:
@@ -294,35 +1094,527 @@ def choose_date_from_ai(ai_date, original_text: str) -> str:
     return today.isoformat()
 
 
+# ================== AI RESPONSE CACHE ==================
+AI_CACHE_SIZE = int(os.environ.get("AI_CACHE_SIZE", "256"))
+AI_CACHE_TTL = int(os.environ.get("AI_CACHE_TTL", str(6 * 3600)))
+# مسار ملف JSON لحفظ الكاش بين التشغيلات (فارغ = بدون حفظ)
+AI_CACHE_PATH = os.environ.get("AI_CACHE_PATH", "")
+AI_CACHE_SAVE_EVERY = 20
+
+
+class AIResponseCache:
+    """كاش LRU محدود الحجم مع TTL لنتائج analyze_with_ai."""
+
+    def __init__(self, max_size, ttl, path=""):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, data)
+        self._dirty = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+        self.load()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            expires_at, data = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return copy.deepcopy(data)
+
+    def put(self, key, data):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, copy.deepcopy(data))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+            self._dirty += 1
+            save_now = self.path and self._dirty >= AI_CACHE_SAVE_EVERY
+        if save_now:
+            self.save()
+
+    def hit_rate(self) -> float:
+        with self._lock:
+            total = self.stats["hits"] + self.stats["misses"]
+            return self.stats["hits"] / total if total else 0.0
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                items = json.load(f)
+        except Exception as e:
+            print("ERROR loading AI cache:", repr(e))
+            return
+        now = time.time()
+        with self._lock:
+            for key, expires_at, data in items[-self.max_size:]:
+                if expires_at > now:
+                    self._entries[key] = (expires_at, data)
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            items = [[k, exp, data] for k, (exp, data) in self._entries.items()]
+            self._dirty = 0
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(items, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print("ERROR saving AI cache:", repr(e))
+
+
+AI_CACHE = AIResponseCache(AI_CACHE_SIZE, AI_CACHE_TTL, AI_CACHE_PATH)
+
+
+def ai_cache_key(text):
+    """اليوم + الرسالة بعد التطبيع (لأن البرومبت فيه today/yesterday)."""
+    normalized = " ".join(str(value) for _, value in _fast_tokens(text or ""))
+    return f"{datetime.now().date().isoformat()}|{normalized}"
+
+
+def analyze_with_ai_cached(text):
+    key = ai_cache_key(text)
+    data = AI_CACHE.get(key)
+    if data is not None:
+        print(f"AI_CACHE hit (rate={AI_CACHE.hit_rate():.2f})")
+        return data
+    data = analyze_with_ai(text)
+    AI_CACHE.put(key, data)
+    return data
+
+
 # ================== BALANCE & EXPENSE HELPERS ==================
-def compute_balance_from_rows(rows):
-    if len(rows) <= 1:
+def _signed_amount(row):
+    """مبلغ الصف بإشارته (+ للبيع و - لغيره)، أو None إذا الصف لا يدخل في الرصيد."""
+    if len(row) < 5:
+        return None
+    proc = row[1].strip() if len(row) > 1 and row[1] else ""
+    amount_str = row[4].strip()
+    if not amount_str:
+        return None
+    try:
+        amt = float(str(amount_str).replace(",", ""))
+    except Exception:
+        return None
+    return amt if proc == "بيع" else -amt
+
+
+def compute_previous_balance():
+    try:
+        return LEDGER.balance()
+    except Exception:
         return 0.0
-    balance = 0.0
-    for row in rows[1:]:
-        if len(row) < 5:
-            continue
-        proc = row[1].strip() if len(row) > 1 and row[1] else ""
-        amount_str = row[4].strip()
-        if not amount_str:
+
+
+# ================== LEDGER MIRROR ==================
+# كل كم ثانية نتحقق من ذيل الورقة قبل الإجابة من الذاكرة
+LEDGER_SYNC_INTERVAL = int(os.environ.get("LEDGER_SYNC_INTERVAL", "30"))
+# بعد فشل مزامنة نخدم الكاش هذه المدة بدون محاولة جديدة (كل محاولة قد تأخذ ثواني)
+SYNC_FAILURE_BACKOFF = int(os.environ.get("SYNC_FAILURE_BACKOFF", "60"))
+LEDGER_COLS = 8
+
+
+def _sync_backing_off(failed_at) -> bool:
+    return failed_at is not None and time.monotonic() - failed_at < SYNC_FAILURE_BACKOFF
+
+
+def _trim_row(row):
+    row = list(row)
+    while row and not str(row[-1]).strip():
+        row.pop()
+    return row
+
+
+def _trim_rows(rows):
+    rows = list(rows)
+    while rows and not rows[-1]:
+        rows.pop()
+    return rows
+
+
+def _same_cells(row, values):
+    """هل صف الورقة يحمل القيم التي أرسلناها؟ (الأرقام قد تعود بتنسيق مختلف)"""
+    for i, v in enumerate(values):
+        a = str(row[i] if i < len(row) else "").strip()
+        b = str(v).strip()
+        if a == b:
             continue
         try:
-            amt = float(str(amount_str).replace(",", ""))
+            if float(a.replace(",", "")) == float(b.replace(",", "")):
+                continue
+        except ValueError:
+            pass
+        return False
+    return True
+
+
+class LedgerMirror:
+    """نسخة محلية من Azba Expenses.
+
+    تُحمّل الورقة كاملة مرة واحدة، وبعدها نضيف الصفوف التي يكتبها البوت
+    ونزامن الذيل فقط (من آخر صف معروف إلى النهاية). إذا تغيّر آخر صف
+    معروف أو نقص عدد الصفوف نعيد التحميل الكامل.
+
+    نحتفظ أيضاً بالرصيد التراكمي بعد كل صف (prefix) حتى يكون الرصيد الحالي
+    O(1). عمود الرصيد المخزن في الورقة (العمود 8) يُقارن مع المحسوب، وعند
+    الاختلاف نعيد الحساب الكامل ونسجل الاختلاف (غالباً تعديل يدوي).
+
+    الصفوف المؤكدة التي لم يكتبها سجل الكتابة بعد تبقى في _unflushed؛ تدخل
+    في الرصيد والتقارير لكنها ليست جزءاً من الورقة (ولا من row_count).
+    """
+
+    def __init__(self, get_sheet):
+        self._get_sheet = get_sheet
+        self._lock = threading.RLock()
+        self._rows = None  # مع صف العناوين
+        self._prefix = []  # الرصيد (غير مقرّب) بعد كل صف بيانات
+        self._agg = None  # PeriodAggregator يُبنى عند أول تقرير
+        self._last_sync = 0.0
+        self._sync_failed_at = None
+        self._unflushed = []  # [رقم العملية في السجل, الصف]
+        self._unflushed_sum = 0.0
+        self.revision = 0
+        self.balance_mismatch = None  # (رقم الصف, المخزن, المحسوب) أو None
+
+    def _width(self):
+        if self._rows:
+            return max(len(self._rows[0]), LEDGER_COLS)
+        return LEDGER_COLS
+
+    def _pad(self, row):
+        row = [str(v) for v in row]
+        return row + [""] * (self._width() - len(row))
+
+    def _extend_index(self, rows):
+        running = self._prefix[-1] if self._prefix else 0.0
+        for row in rows:
+            signed = _signed_amount(row)
+            if signed is not None:
+                running += signed
+            self._prefix.append(running)
+            if self._agg is not None:
+                e = _parse_expense_row(row)
+                if e is not None:
+                    self._agg.add(e)
+
+    def _stored_balance_mismatch(self):
+        """نقارن الرصيد المخزن في آخر صف مع المحسوب؛ نرجع (صف, مخزن, محسوب) أو None."""
+        if not self._rows or len(self._rows) <= 1:
+            return None
+        last = self._rows[-1]
+        stored_str = last[7].strip() if len(last) > 7 and last[7] else ""
+        if not stored_str:
+            return None
+        try:
+            stored = float(stored_str.replace(",", ""))
         except Exception:
-            continue
-        if proc == "بيع":
-            balance += amt
-        else:
-            balance -= amt
-    return round(balance, 2)
+            return None
+        computed = round(self._prefix[-1], 2)
+        if abs(stored - computed) > 0.005:
+            return len(self._rows), stored, computed
+        return None
+
+    def _reload(self):
+        rows = _sheets_call(self._get_sheet().get_all_values)
+        self._rows = [list(r) for r in rows]
+        self._prefix = []
+        self._agg = None
+        self._extend_index(self._rows[1:])
+        self.revision += 1
+        self.balance_mismatch = self._stored_balance_mismatch()
+        if self.balance_mismatch:
+            print("WARNING ledger stored balance differs from computed:", self.balance_mismatch)
+
+    def sync(self):
+        """نقرأ الذيل فقط؛ الصف الأول من المدى هو آخر صف نعرفه للتأكد أنه لم يتغير."""
+        with self._lock:
+            if self._rows is None:
+                self._reload()
+            else:
+                known = len(self._rows)
+                tail = _sheets_call(
+                    self._get_sheet().get, f"A{max(known, 1)}:{chr(64 + self._width())}"
+                )
+                if known == 0:
+                    if tail:
+                        self._reload()
+                elif not tail or _trim_row(tail[0]) != _trim_row(self._rows[-1]):
+                    self._reload()
+                elif len(tail) > 1:
+                    new_rows = [self._pad(r) for r in tail[1:]]
+                    self._rows.extend(new_rows)
+                    self._extend_index(new_rows)
+                    self.revision += 1
+                    if self._stored_balance_mismatch():
+                        # الصفوف الجديدة لا تتفق مع الرصيد المحسوب → إعادة حساب كاملة
+                        self._reload()
+            self._last_sync = time.monotonic()
+
+    def check_changes(self):
+        """بعد تغيّر الملف: نقارن الأعمدة A:E كاملة (تاريخ، عملية، نوع، بند،
+        مبلغ)؛ أي صف قديم تعدّل أو حُذف → إعادة تحميل، وإلا نزامن الذيل."""
+        with self._lock:
+            if self._rows is None:
+                self._reload()
+                self._last_sync = time.monotonic()
+                return
+        # القراءة الكبيرة خارج القفل حتى لا تنتظرها /balance والمعاينات
+        cells = _sheets_call(self._get_sheet().get, "A1:E")
+        sheet = _trim_rows([_trim_row([str(v) for v in r[:5]]) for r in cells])
+        with self._lock:
+            known = _trim_rows([_trim_row([str(v) for v in r[:5]]) for r in self._rows])
+            if len(sheet) < len(known) or sheet[: len(known)] != known:
+                self._reload()
+            else:
+                self.sync()
+            self._last_sync = time.monotonic()
+
+    def mark_fresh(self):
+        with self._lock:
+            if self._rows is not None:
+                self._last_sync = time.monotonic()
+
+    def ensure_fresh(self, max_age=None):
+        max_age = _default_max_age(LEDGER_SYNC_INTERVAL) if max_age is None else max_age
+        with self._lock:
+            if self._rows is not None and time.monotonic() - self._last_sync < max_age:
+                return
+            if self._rows is not None and max_age > 0 and _sync_backing_off(self._sync_failed_at):
+                return
+            try:
+                self.sync()
+                self._sync_failed_at = None
+            except Exception as e:
+                self._sync_failed_at = time.monotonic()
+                if self._rows is None or max_age == 0:
+                    raise
+                print("ERROR syncing ledger mirror, serving cached rows:", repr(e))
+
+    def row_count(self, max_age=None):
+        """عدد الصفوف في الورقة (مع العناوين)."""
+        with self._lock:
+            self.ensure_fresh(max_age)
+            return len(self._rows)
+
+    def last_row(self, max_age=None):
+        """(رقم آخر صف, محتواه) أو (None, None) إذا لا توجد بيانات."""
+        with self._lock:
+            self.ensure_fresh(max_age)
+            if len(self._rows) <= 1:
+                return None, None
+            return len(self._rows), list(self._rows[-1])
+
+    def balance(self, max_age=None):
+        with self._lock:
+            self.ensure_fresh(max_age)
+            base = self._prefix[-1] if self._prefix else 0.0
+            return round(base + self._unflushed_sum, 2)
+
+    def _aggregates(self):
+        if self._agg is None:
+            self._agg = new_ledger_index(self._rows[1:] + [row for _, row in self._unflushed])
+        return self._agg
+
+    def summarize(self, start_date, end_date, max_age=None):
+        return self.summarize_windows({"period": (start_date, end_date)}, max_age)["period"]
+
+    def summarize_windows(self, windows, max_age=None):
+        """{اسم: (الدخل, المصروف, الصافي)} لعدة نوافذ بمزامنة واحدة ومن نفس التجميع."""
+        with self._lock:
+            self.ensure_fresh(max_age)
+            return self._aggregates().summarize_windows(windows)
+
+    def query(self, start_date, end_date, process=None, type_=None, item=None, max_age=None):
+        with self._lock:
+            self.ensure_fresh(max_age)
+            return self._aggregates().query(start_date, end_date, process, type_, item)
+
+    def prefetch(self):
+        """نجهز الصفوف والتجميع اليومي مسبقاً (يُستدعى بالتوازي مع الذكاء الاصطناعي)."""
+        with self._lock:
+            self.ensure_fresh()
+            self._aggregates()
+
+    def export_rows(self):
+        """نسخة من صفوف الورقة (بدون الصفوف المعلقة)، أو None إذا لم تُحمّل."""
+        with self._lock:
+            return None if self._rows is None else [list(r) for r in self._rows]
+
+    def load_snapshot(self, rows, ordinals, amounts):
+        """نبني الدفتر من لقطة محلية بدون تحليل النصوص.
+
+        ordinals[i]: تاريخ الصف كـ ordinal أو 0 إذا الصف لا يدخل التقارير.
+        amounts[i]: المبلغ أو NaN إذا لا يدخل الرصيد.
+        """
+        with self._lock:
+            self._rows = rows
+            self._prefix = []
+            if LEDGER_BACKEND == "numpy" and np is not None:
+                agg = new_ledger_index(rows[1:], ordinals, amounts)
+            else:
+                agg = PeriodAggregator()
+            build_days = isinstance(agg, PeriodAggregator)
+            running = 0.0
+            for row, day, amount in zip(rows[1:], ordinals, amounts):
+                if amount == amount:
+                    process = row[1].strip()
+                    running += amount if process == "بيع" else -amount
+                    if day and build_days:
+                        agg.add(ExpenseRecord(day, amount, process, row[2].strip(), row[3].strip()))
+                self._prefix.append(running)
+            for _, row in self._unflushed:
+                e = _parse_expense_row(row)
+                if e is not None:
+                    agg.add(e)
+            self._agg = agg
+            self.revision += 1
+            self.balance_mismatch = self._stored_balance_mismatch()
+            # اللقطة تُعتبر حديثة حتى تنتهي المزامنة في الخلفية
+            self._last_sync = time.monotonic()
+
+    def add_unflushed(self, op_id, row):
+        """صف مؤكد محفوظ في سجل الكتابة ولم يصل الورقة بعد."""
+        with self._lock:
+            if any(oid == op_id for oid, _ in self._unflushed):
+                return
+            row = self._pad(row)
+            self._unflushed.append([op_id, row])
+            self._unflushed_sum += _signed_amount(row) or 0.0
+            if self._agg is not None:
+                e = _parse_expense_row(row)
+                if e is not None:
+                    self._agg.add(e)
+            self.revision += 1
+
+    def drop_unflushed(self, op_id):
+        """نزيل صفاً معلقاً (أُلغي أو كُتب)؛ نرجع الصف أو None."""
+        with self._lock:
+            for i, (oid, row) in enumerate(self._unflushed):
+                if oid != op_id:
+                    continue
+                del self._unflushed[i]
+                self._unflushed_sum -= _signed_amount(row) or 0.0
+                if not self._unflushed:
+                    self._unflushed_sum = 0.0
+                if self._agg is not None:
+                    e = _parse_expense_row(row)
+                    if e is not None:
+                        self._agg.add(e, sign=-1)
+                self.revision += 1
+                return row
+            return None
+
+    def stage_row(self, values, persist):
+        """نحسب رصيد صف جديد من الرصيد الحالي ونضيفه كصف معلق.
+
+        persist(row) تحفظه في سجل الكتابة وترجع رقم العملية. القفل يضمن أن
+        تأكيدين متزامنين لا يبنيان على نفس الرصيد. نرجع (الرصيد السابق, الصف).
+        """
+        with self._lock:
+            prev_balance = self.balance()
+            row = list(values)
+            signed = _signed_amount(self._pad(row)) or 0.0
+            row.append(round(prev_balance + signed, 2))
+            self.add_unflushed(persist(row), row)
+            return prev_balance, row
+
+    def write_rows(self, items, persist=None):
+        """نكتب صفوفاً معلقة بالترتيب في append_rows واحد.
+
+        items: قائمة (رقم العملية, القيم بدون الرصيد). الرصيد يُحسب هنا من
+        آخر رصيد في الورقة. persist(values) تحفظ الصفوف الكاملة قبل الإرسال
+        حتى نتحقق منها بعد خطأ (find_written). نرجع رقم الصف لكل عنصر من مدى رد append.
+        """
+        with self._lock:
+            self.ensure_fresh(max_age=0)
+            running = self._prefix[-1] if self._prefix else 0.0
+            values = []
+            for _, row in items:
+                running += _signed_amount(self._pad(row)) or 0.0
+                values.append(list(row) + [round(running, 2)])
+            if persist is not None:
+                persist(values)
+            resp = _sheets_call(
+                self._get_sheet().append_rows,
+                values,
+                value_input_option="USER_ENTERED",
+                include_values_in_response=True,
+            )
+            updates = (resp or {}).get("updates", {})
+            start = _range_start_row(updates.get("updatedRange"))
+            stored = updates.get("updatedData", {}).get("values") or values
+
+            for op_id, _ in items:
+                self.drop_unflushed(op_id)
+            if start is None or start == len(self._rows) + 1:
+                new_rows = [self._pad(r) for r in stored]
+                self._rows.extend(new_rows)
+                self._extend_index(new_rows)
+                self.revision += 1
+                if start is None:
+                    start = len(self._rows) - len(new_rows) + 1
+            else:
+                # أحد أضاف صفوفاً قبلنا → نزامن الذيل في القراءة القادمة
+                self._last_sync = 0.0
+            return [start + i for i in range(len(items))]
+
+    def find_written(self, items):
+        """append فشل بعد الإرسال وقد يكون نُفذ: نقرأ الورقة ونبحث عن كل صف.
+
+        items: قائمة (رقم العملية, الصف كما أُرسل مع الرصيد). نرجع رقم الصف
+        لكل عنصر وُجد (ونزيله من المعلقة) أو None ليُكتب من جديد.
+        """
+        with self._lock:
+            self.ensure_fresh(max_age=0)
+            found = []
+            used = set()
+            for op_id, sent in items:
+                row_index = None
+                for i in range(len(self._rows), 1, -1):
+                    if i not in used and _same_cells(self._rows[i - 1], sent):
+                        row_index = i
+                        break
+                if row_index is not None:
+                    used.add(row_index)
+                    self.drop_unflushed(op_id)
+                found.append(row_index)
+            return found
+
+    def delete_local(self, row_index):
+        """نحذف صفاً محلياً بعد حذفه من الورقة (عادة آخر صف)."""
+        with self._lock:
+            if self._rows is None or len(self._rows) <= 1:
+                return
+            if row_index != len(self._rows):
+                # ليس آخر صف نعرفه → المزامنة القادمة تكتشف الفرق وتعيد التحميل
+                self._last_sync = 0.0
+                return
+            row = self._rows.pop()
+            self._prefix.pop()
+            if self._agg is not None:
+                e = _parse_expense_row(row)
+                if e is not None:
+                    self._agg.add(e, sign=-1)
+            self.revision += 1
+            self.balance_mismatch = self._stored_balance_mismatch()
 
 
-def compute_previous_balance(sheet):
-    try:
-        rows = sheet.get_all_values()
-    except Exception:
-        return 0.0
-    return compute_balance_from_rows(rows)
+LEDGER = LedgerMirror(get_expense_sheet)
 
 
 # ================== LIVESTOCK SUMMARY ==================
@@ -341,106 +1633,270 @@ def _norm_arabic(s: str) -> str:
     return s
 
 
-def update_livestock_summary(animal_type: str, breed: str, count: int, movement: str):
-    """تحديث تبويب المواشي - إجمالي حسب حركة واحدة."""
-    animal_type_raw = animal_type or ""
-    breed_raw = breed or ""
-    animal_type_n = _norm_arabic(animal_type_raw)
-    breed_n = _norm_arabic(breed_raw)
-    movement = (movement or "").strip()
+MINUS_MOVES = {"بيع", "نقص", "نفوق"}
+
 
+def _parse_count(value):
     try:
-        sheet = get_livestock_summary_sheet()
-        rows = sheet.get_all_values()
-    except Exception as e:
-        print("ERROR accessing livestock summary sheet:", repr(e))
-        return
+        return int(float(value)) if value is not None else None
+    except Exception:
+        return None
+
 
-    current_row_index = None
-    current_value = 0
-    current_breed_display = breed_raw
-    same_type_rows = []
-
-    for idx, row in enumerate(rows[1:], start=2):
-        a_raw = row[0] or ""
-        b_raw = row[1] or ""
-        a_n = _norm_arabic(a_raw)
-        b_n = _norm_arabic(b_raw)
-        if a_n == animal_type_n:
-            same_type_rows.append((idx, a_raw, b_raw, row))
-        if a_n == animal_type_n and breed_n and b_n == breed_n:
-            current_row_index = idx
-            current_breed_display = b_raw
+def valid_livestock_entries(entries):
+    """نرجع فقط البنود التي فيها عدد صحيح موجب، مع count كرقم."""
+    valid = []
+    for e in entries or []:
+        count_val = _parse_count(e.get("count"))
+        if count_val is None or count_val <= 0:
+            continue
+        valid.append(
+            {
+                "animal_type": e.get("animal_type") or "",
+                "breed": e.get("breed") or "",
+                "movement": (e.get("movement") or "").strip(),
+                "count": count_val,
+            }
+        )
+    return valid
+
+
+def livestock_delta(movement: str, count: int) -> int:
+    return -count if movement in MINUS_MOVES else count
+
+
+# كل كم ثانية نتأكد أن التبويب لم يُعدّل يدوياً قبل الاعتماد على الفهرس
+LIVESTOCK_SYNC_INTERVAL = int(os.environ.get("LIVESTOCK_SYNC_INTERVAL", "60"))
+
+
+class LivestockSummary:
+    """نسخة محلية من تبويب المواشي - إجمالي مع فهرس مطبّع.
+
+    by_key: (نوع الحيوان, السلالة) بعد _norm_arabic → أول صف مطابق.
+    by_type: نوع الحيوان المطبّع → كل صفوفه بالترتيب.
+    الفهرس يُبنى مرة من الورقة ويُحدّث مع كل كتابة من البوت، ونعيد بناءه
+    فقط إذا تغيّر محتوى التبويب من خارج البوت.
+    """
+
+    def __init__(self, get_sheet):
+        self._get_sheet = get_sheet
+        self._lock = threading.RLock()
+        self._rows = None  # مع صف العناوين
+        self._by_key = {}
+        self._by_type = {}
+        self._last_sync = 0.0
+        self._sync_failed_at = None
+
+    def _index_row(self, idx, row):
+        a_n = _norm_arabic(row[0] if len(row) > 0 and row[0] else "")
+        b_n = _norm_arabic(row[1] if len(row) > 1 and row[1] else "")
+        self._by_type.setdefault(a_n, []).append(idx)
+        if b_n:
+            self._by_key.setdefault((a_n, b_n), idx)
+
+    def _set_rows(self, rows):
+        self._rows = [list(r) for r in rows]
+        self._by_key = {}
+        self._by_type = {}
+        for idx, row in enumerate(self._rows[1:], start=2):
+            self._index_row(idx, row)
+        self._last_sync = time.monotonic()
+
+    def mark_fresh(self):
+        with self._lock:
+            if self._rows is not None:
+                self._last_sync = time.monotonic()
+
+    def ensure_fresh(self, max_age=None):
+        max_age = _default_max_age(LIVESTOCK_SYNC_INTERVAL) if max_age is None else max_age
+        with self._lock:
+            if self._rows is not None and time.monotonic() - self._last_sync < max_age:
+                return
+            if self._rows is not None and max_age > 0 and _sync_backing_off(self._sync_failed_at):
+                return
+            try:
+                rows = _sheets_call(self._get_sheet().get_all_values)
+                self._sync_failed_at = None
+            except Exception as e:
+                self._sync_failed_at = time.monotonic()
+                if self._rows is None or max_age == 0:
+                    raise
+                print("ERROR syncing livestock summary, serving cached rows:", repr(e))
+                return
+            if self._rows is not None and [_trim_row(r) for r in rows] == [
+                _trim_row(r) for r in self._rows
+            ]:
+                self._last_sync = time.monotonic()
+                return
+            self._set_rows(rows)
+
+    def invalidate(self):
+        with self._lock:
+            self._rows = None
+
+    def rows(self):
+        """نسخة من الصفوف المعروفة (بدون مزامنة)، أو None."""
+        with self._lock:
+            return None if self._rows is None else [list(r) for r in self._rows]
+
+    def replace(self, rows):
+        """بعد إعادة كتابة التبويب بالكامل (حصر) نعتمد الصفوف الجديدة مباشرة."""
+        with self._lock:
+            self._set_rows([[str(v) for v in r] for r in rows])
+
+    def _count_at(self, idx):
+        row = self._rows[idx - 1]
+        return _parse_count((row[2] if len(row) > 2 else "").strip() or "0") or 0
+
+    def _apply_entry(self, animal_type, breed, count, movement):
+        """نطبق حركة واحدة على الذاكرة؛ نرجع (رقم الصف, العدد القديم, العدد الجديد)."""
+        animal_type_raw = animal_type or ""
+        breed_raw = breed or ""
+        animal_type_n = _norm_arabic(animal_type_raw)
+        breed_n = _norm_arabic(breed_raw)
+        movement = (movement or "").strip()
+
+        same_type_rows = self._by_type.get(animal_type_n) or []
+        current_row_index = self._by_key.get((animal_type_n, breed_n)) if breed_n else None
+        if current_row_index is None and same_type_rows:
+            # أول صف من نفس النوع (للحصر نستبدل العدد، ولغيره نعدل عليه)
+            current_row_index = same_type_rows[0]
+        current_value = 0
+        if current_row_index is not None and movement != "إجمالي":
+            current_value = self._count_at(current_row_index)
+
+        if movement == "إجمالي":
+            new_value = count
+        else:
+            new_value = max(current_value + livestock_delta(movement, count), 0)
+
+        if current_row_index is None:
+            row = [animal_type_raw, breed_raw or "اخرى", str(new_value)]
+            self._rows.append(row)
+            self._index_row(len(self._rows), row)
+            return len(self._rows), current_value, new_value
+
+        row = self._rows[current_row_index - 1]
+        while len(row) < 3:
+            row.append("")
+        row[2] = str(new_value)
+        return current_row_index, current_value, new_value
+
+    def apply(self, entries, persist=None):
+        """نطبق عدة حركات في الذاكرة ثم نكتبها كلها في batch_update واحد.
+
+        persist(cells) تحفظ الخلايا المخططة [صف, نوع, سلالة, عدد] قبل الإرسال
+        حتى نتحقق منها بعد خطأ (cells_written) بدل تطبيق الحركات مرتين.
+        """
+        with self._lock:
+            self.ensure_fresh()
+            existing = len(self._rows)
+
+            results = []
+            changed = set()
             try:
-                current_value = int(float((row[2] or "0").strip()))
+                for e in entries:
+                    row_idx, old, new = self._apply_entry(
+                        e["animal_type"], e["breed"], e["count"], e["movement"]
+                    )
+                    changed.add(row_idx)
+                    results.append(
+                        dict(
+                            e,
+                            delta=livestock_delta(e["movement"], e["count"]),
+                            row=row_idx,
+                            old=old,
+                            new=new,
+                        )
+                    )
+
+                data = []
+                for row_idx in sorted(r for r in changed if r <= existing):
+                    data.append(
+                        {"range": f"C{row_idx}", "values": [[int(self._rows[row_idx - 1][2])]]}
+                    )
+                if len(self._rows) > existing:
+                    new_rows = [[r[0], r[1], int(r[2])] for r in self._rows[existing:]]
+                    data.append(
+                        {"range": f"A{existing + 1}:C{len(self._rows)}", "values": new_rows}
+                    )
+
+                if persist is not None:
+                    persist(
+                        [
+                            [r, self._rows[r - 1][0], self._rows[r - 1][1], self._count_at(r)]
+                            for r in sorted(changed)
+                        ]
+                    )
+                sheet = self._get_sheet()
+                if len(self._rows) > sheet.row_count:
+                    _sheets_call(sheet.add_rows, len(self._rows) - sheet.row_count)
+                _sheets_call(sheet.batch_update, data, value_input_option="USER_ENTERED")
             except Exception:
-                current_value = 0
-            break
+                # الذاكرة سبقت الورقة → نعيد التحميل في المرة القادمة
+                self._rows = None
+                raise
+            return results
+
+    def cells_written(self, cells):
+        """بعد خطأ في batch_update: هل كل خلية مخططة موجودة في الورقة بقيمتها الجديدة؟"""
+        with self._lock:
+            self.ensure_fresh(max_age=0)
+            for row_idx, animal, breed, count in cells:
+                if row_idx > len(self._rows):
+                    return False
+                row = self._rows[row_idx - 1]
+                if _norm_arabic(row[0] if row else "") != _norm_arabic(animal):
+                    return False
+                if _norm_arabic(row[1] if len(row) > 1 else "") != _norm_arabic(breed):
+                    return False
+                if self._count_at(row_idx) != count:
+                    return False
+            return True
+
+    def totals(self):
+        with self._lock:
+            self.ensure_fresh()
+            totals = {}
+            for row in self._rows[1:]:
+                if len(row) < 3:
+                    continue
+                animal = (row[0] or "").strip()
+                breed = (row[1] or "").strip()
+                count_str = (row[2] or "").strip()
+                if not count_str:
+                    continue
+                try:
+                    cnt = int(float(count_str))
+                except Exception:
+                    continue
+                totals[(animal or "-", breed or "-")] = cnt
+            return totals
 
-    if current_row_index is None and movement != "إجمالي" and same_type_rows:
-        idx, a_raw, b_raw, row = same_type_rows[0]
-        current_row_index = idx
-        current_breed_display = b_raw
-        try:
-            current_value = int(float((row[2] or "0").strip()))
-        except Exception:
-            current_value = 0
 
-    if movement == "إجمالي":
-        new_value = count
-        if current_row_index is None and same_type_rows:
-            idx, a_raw, b_raw, row = same_type_rows[0]
-            current_row_index = idx
-            current_breed_display = b_raw
-    else:
-        minus_moves = {"بيع", "نقص", "نفوق"}
-        sign = -1 if movement in minus_moves else 1
-        new_value = current_value + sign * count
-        if new_value < 0:
-            new_value = 0
-
-    if current_row_index is None:
-        display_animal = animal_type_raw or (same_type_rows[0][1] if same_type_rows else "")
-        display_breed = (
-            breed_raw
-            or current_breed_display
-            or (same_type_rows[0][2] if same_type_rows else "اخرى")
-        )
-        try:
-            sheet.append_row(
-                [display_animal, display_breed, new_value],
-                value_input_option="USER_ENTERED",
-            )
-        except Exception as e:
-            print("ERROR appending summary row:", repr(e))
-    else:
-        try:
-            sheet.update_cell(current_row_index, 3, new_value)
-        except Exception as e:
-            print("ERROR updating summary row:", repr(e))
+LIVESTOCK = LivestockSummary(get_livestock_summary_sheet)
+
+
+def apply_livestock_entries(entries, persist=None):
+    """نطبق عدة حركات مواشي بقراءة واحدة (أو بدون قراءة من الفهرس) وكتابة واحدة.
+
+    entries بالشكل الذي يرجعه valid_livestock_entries. نرجع نتيجة لكل بند:
+    dict فيه animal_type, breed, movement, count, delta, row, old, new.
+    أي خطأ في Google Sheets يُرفع للمستدعي.
+    """
+    if not entries:
+        return []
+    return LIVESTOCK.apply(entries, persist)
 
 
 def get_livestock_totals():
-    sheet = get_livestock_summary_sheet()
-    rows = sheet.get_all_values()
-    totals = {}
-    for row in rows[1:]:
-        if len(row) < 3:
-            continue
-        animal = (row[0] or "").strip()
-        breed = (row[1] or "").strip()
-        count_str = (row[2] or "").strip()
-        if not count_str:
-            continue
-        try:
-            cnt = int(float(count_str))
-        except Exception:
-            continue
-        totals[(animal or "-", breed or "-")] = cnt
-    return totals
+    return LIVESTOCK.totals()
 
 
 def reply_livestock_status(update):
+    # تعديلات المواشي المؤكدة تُكتب في الخلفية؛ ننتظرها حتى يكون الكشف دقيقاً
+    if not JOURNAL.flush():
+        update.message.reply_text("⏳ بعض تعديلات المواشي لم تُكتب بعد، الأعداد التالية قد لا تشملها.")
     try:
         totals = get_livestock_totals()
     except Exception as e:
@@ -465,132 +1921,1377 @@ def reply_livestock_status(update):
     update.message.reply_text(msg)
 
 
-# ================== REPORT HELPERS ==================
-def load_expenses():
-    sheet = get_expense_sheet()
-    rows = sheet.get_all_values()
-    expenses = []
-    for row in rows[1:]:
-        if len(row) < 5:
-            continue
-        date_str = row[0].strip()
-        process = row[1].strip() if len(row) > 1 and row[1] else ""
-        type_ = row[2].strip() if len(row) > 2 and row[2] else ""
-        item = row[3].strip() if len(row) > 3 and row[3] else ""
-        amount_str = row[4].strip()
-        if not date_str or not amount_str:
-            continue
+# ================== WRITE JOURNAL ==================
+# العمليات المؤكدة تُحفظ أولاً في سجل محلي (SQLite) ثم يكتبها خيط خلفي في Google Sheets
+JOURNAL_DB_PATH = os.environ.get("JOURNAL_DB_PATH", "journal.sqlite3")
+JOURNAL_POLL_INTERVAL = 5
+JOURNAL_RETRY_BASE = 2
+JOURNAL_QUOTA_RETRY_BASE = 15
+JOURNAL_RETRY_MAX = 300
+# أقصى انتظار لمستخدم يطلب كتابة فورية (مثل /livestock)
+JOURNAL_FLUSH_WAIT = float(os.environ.get("JOURNAL_FLUSH_WAIT", "3"))
+
+
+class _WriterLock:
+    """قفل كاتب السجل. عند خروج آخر مستوى (القفل reentrant) نبلغ كاشف التغييرات
+    أن تعديل الملف ناتج عن كتاباتنا، فلا يعيد فحص التبويبات بسببه."""
+
+    def __init__(self, journal):
+        self._journal = journal
+
+    def __enter__(self):
+        self._journal._flush_lock.acquire()
+        self._journal._own_depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        j = self._journal
         try:
-            d = datetime.strptime(date_str[:10], "%Y-%m-%d").date()
-            amount = float(str(amount_str).replace(",", ""))
-        except Exception:
-            continue
-        expenses.append(
-            {"date": d, "amount": amount, "process": process, "type": type_, "item": item}
-        )
-    return expenses
+            j._own_depth -= 1
+            if j._own_depth == 0 and j._own_started:
+                if exc_type is None:
+                    CHANGES.end_own_write(j._own_token)
+                j._own_started = False
+                j._own_token = None
+        finally:
+            j._flush_lock.release()
+        return False
 
 
-def summarize_period(expenses, start_date, end_date):
-    income = 0.0
-    expense = 0.0
-    net = 0.0
+class WriteJournal:
+    """سجل كتابة مؤجلة (write-behind) لكل تعديلات Google Sheets من /confirm.
+
+    أنواع العمليات:
+      expense:   {"values": [..7 أعمدة..], "livestock": [...]} صف في Azba Expenses
+      livestock: {"livestock": [...]} تعديل على تبويب المواشي
+      baseline:  {"rows": [...]} حصر كامل يعيد كتابة تبويب المواشي
+
+    الخيط الخلفي يجمع العمليات المتتالية (حتى أول حصر) في كتابة واحدة لكل
+    تبويب: batch_update للمواشي، append_rows للدفتر، append_rows للميتا.
+    كل خطوة تُسجل في العملية نفسها حتى لا تتكرر عند إعادة المحاولة، وما
+    سنكتبه يُحفظ قبل الإرسال (livestock_sent, sent, meta_sent): الكتابة قد
+    تصل الورقة ثم يفشل الرد، فنتحقق من الورقة قبل إعادة تطبيقها.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()  # الوصول لقاعدة البيانات
+        # كاتب واحد في كل مرة: هو وحده يُلحق صفوف الدفتر ويحدد أرقامها
+        self._flush_lock = threading.RLock()
+        self._own_depth = 0
+        self._own_started = False
+        self._own_token = None
+        self._idle = threading.Condition()
+        self._wake = threading.Event()
+        self._retry_at = 0.0
+        self._urgent = False  # مستخدم ينتظر flush() → أولوية تفاعلية
+        self._thread = None
+        self.attempts = 0
+        self.last_error = None
+        self._conn = None
+
+    def _db(self):
+        """الاتصال يُفتح عند أول استخدام (وليس عند الاستيراد)؛ يُستدعى تحت self._lock."""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS journal ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " kind TEXT NOT NULL,"
+                " payload TEXT NOT NULL,"
+                " created_at REAL NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+
+    def _ops(self):
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT id, kind, payload FROM journal ORDER BY id"
+            ).fetchall()
+        return [[op_id, kind, json.loads(payload)] for op_id, kind, payload in rows]
+
+    def _save(self, ops):
+        with self._lock:
+            self._db().execute("BEGIN")
+            self._db().executemany(
+                "UPDATE journal SET payload = ? WHERE id = ?",
+                [(json.dumps(op[2], ensure_ascii=False), op[0]) for op in ops],
+            )
+            self._db().execute("COMMIT")
+
+    def _delete(self, op_ids):
+        with self._lock:
+            self._db().execute("BEGIN")
+            self._db().executemany("DELETE FROM journal WHERE id = ?", [(i,) for i in op_ids])
+            self._db().execute("COMMIT")
+
+    def submit(self, kind, payload):
+        """نحفظ العملية (بعد رجوع هذه الدالة هي محفوظة على القرص)؛ نرجع رقمها."""
+        data = json.dumps(payload, ensure_ascii=False)
+        with self._lock:
+            cur = self._db().execute(
+                "INSERT INTO journal (kind, payload, created_at) VALUES (?, ?, ?)",
+                (kind, data, time.time()),
+            )
+            op_id = cur.lastrowid
+        self._wake.set()
+        return op_id
+
+    def submit_expense(self, values, entries):
+        """نسجل عملية مالية ونضيفها للدفتر المحلي؛ نرجع (الرصيد السابق, الرصيد الجديد)."""
+        prev_balance, row = LEDGER.stage_row(
+            values,
+            lambda row: self.submit(
+                "expense", {"values": list(values), "balance": row[-1], "livestock": entries}
+            ),
+        )
+        return prev_balance, row[-1]
+
+    def size(self, kind=None) -> int:
+        with self._lock:
+            if kind is None:
+                return self._db().execute("SELECT COUNT(*) FROM journal").fetchone()[0]
+            return self._db().execute(
+                "SELECT COUNT(*) FROM journal WHERE kind = ?", (kind,)
+            ).fetchone()[0]
+
+    def restore(self):
+        """بعد إعادة التشغيل: نعيد الصفوف المالية غير المكتوبة إلى الدفتر المحلي."""
+        for op_id, kind, payload in self._ops():
+            if kind == "expense" and "row" not in payload:
+                LEDGER.add_unflushed(op_id, payload["values"] + [payload.get("balance", "")])
+
+    def writer(self):
+        """قفل الكاتب؛ من يمسكه (مثل /undo) يضمن أن الدفتر لا يتغير من البوت."""
+        return _WriterLock(self)
+
+    def mark_own_write(self):
+        """تحت قفل الكاتب قبل أول كتابة في Sheets: نسجل وقت تعديل الملف الحالي."""
+        if not self._own_started:
+            self._own_started = True
+            self._own_token = CHANGES.begin_own_write()
+
+    def cancel_last_expense(self):
+        """نلغي آخر عملية مالية إن لم يبدأ الخيط بكتابتها؛ نرجع صفها أو None."""
+        with self._flush_lock:
+            expenses = [op for op in self._ops() if op[1] == "expense"]
+            if not expenses:
+                return None
+            op_id, _, payload = expenses[-1]
+            if "row" in payload or payload.get("livestock_done"):
+                return None
+            self._delete([op_id])
+            LEDGER.drop_unflushed(op_id)
+            return payload["values"] + [payload.get("balance", "")]
+
+    def flush(self, timeout=JOURNAL_FLUSH_WAIT) -> bool:
+        """نطلب كتابة فورية وننتظر حتى يفرغ السجل.
+
+        إذا فشلت آخر محاولة ولم تنته فترة التراجع بعد، لا نتجاوزها (Sheets
+        غالباً ما زال معطلاً)؛ ننتظر فقط إن كانت المحاولة القادمة ضمن المهلة.
+        """
+        now = time.monotonic()
+        deadline = now + timeout
+        self._urgent = True
+        if self._retry_at > now:
+            if self._retry_at > deadline:
+                return self.size() == 0
+        else:
+            self._retry_at = 0.0
+            self._wake.set()
+        with self._idle:
+            while self.size():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
 
-    for e in expenses:
-        if not (start_date <= e["date"] <= end_date):
-            continue
-        amt = e["amount"]
-        if e["process"] == "بيع":
-            income += amt
-            net += amt
+    def _flush_run(self, run):
+        """عمليات متتالية (بدون حصر): مواشي ← دفتر ← ميتا، كتابة واحدة لكل تبويب."""
+        todo = [op for op in run if not op[2].get("livestock_done")]
+        # محاولة سابقة أرسلت خلايا المواشي ثم فشلت: إن وصلت فلا نطبق الحركات مرة ثانية
+        plans = {}
+        for op in todo:
+            if "livestock_sent" in op[2]:
+                plans.setdefault(json.dumps(op[2]["livestock_sent"]), []).append(op)
+        for cells, ops in plans.items():
+            if LIVESTOCK.cells_written(json.loads(cells)):
+                for op in ops:
+                    op[2]["livestock_done"] = True
+        todo = [op for op in todo if not op[2].get("livestock_done")]
+        with_entries = [op for op in todo if op[2].get("livestock")]
+
+        def persist_livestock(cells):
+            for op in with_entries:
+                op[2]["livestock_sent"] = cells
+            self._save(with_entries)
+
+        entries = [e for op in with_entries for e in op[2]["livestock"]]
+        if entries:
+            apply_livestock_entries(entries, persist_livestock)
+        if todo:
+            for op in todo:
+                op[2]["livestock_done"] = True
+            self._save(todo)
+
+        expenses = [op for op in run if op[1] == "expense" and "row" not in op[2]]
+        sent = [op for op in expenses if "sent" in op[2]]
+        if sent:
+            found = LEDGER.find_written([(op[0], op[2]["sent"]) for op in sent])
+            for op, row_index in zip(sent, found):
+                if row_index is not None:
+                    op[2]["row"] = row_index
+            self._save(sent)
+            expenses = [op for op in expenses if "row" not in op[2]]
+
+        def persist_rows(values):
+            for op, row in zip(expenses, values):
+                op[2]["sent"] = row
+            self._save(expenses)
+
+        if expenses:
+            rows = LEDGER.write_rows([(op[0], op[2]["values"]) for op in expenses], persist_rows)
+            for op, row_index in zip(expenses, rows):
+                op[2]["row"] = row_index
+            self._save(expenses)
+
+        meta_ops = [op for op in run if op[1] == "expense" and op[2].get("livestock")]
+        if any(op[2].get("meta_sent") for op in meta_ops):
+            META.reload()
+            meta_ops = [
+                op for op in meta_ops if not (op[2].get("meta_sent") and self._meta_written(op))
+            ]
+        if meta_ops:
+            for op in meta_ops:
+                op[2]["meta_sent"] = True
+            self._save(meta_ops)
+            META.add_many([(op[2]["row"], self._meta_entries(op)) for op in meta_ops])
+
+    @staticmethod
+    def _meta_entries(op):
+        return [
+            (e["animal_type"], e["breed"], livestock_delta(e["movement"], e["count"]))
+            for e in op[2]["livestock"]
+        ]
+
+    def _meta_written(self, op):
+        existing = [(a, b, d) for _, a, b, d in META.entries_for(op[2]["row"])]
+        return all((a or "", b or "", d) in existing for a, b, d in self._meta_entries(op))
+
+    def _flush_baseline(self, op):
+        rows = op[2]["rows"]
+        rewrite_worksheet(get_livestock_summary_sheet(), [LIVESTOCK_HEADER] + rows)
+        LIVESTOCK.replace([LIVESTOCK_HEADER] + rows)
+
+    def flush_once(self):
+        with self.writer():
+            ops = self._ops()
+            if ops:
+                self.mark_own_write()
+            while ops:
+                if ops[0][1] == "baseline":
+                    run = [ops.pop(0)]
+                    self._flush_baseline(run[0])
+                else:
+                    run = []
+                    while ops and ops[0][1] != "baseline":
+                        run.append(ops.pop(0))
+                    self._flush_run(run)
+                self._delete([op[0] for op in run])
+
+    def _loop(self):
+        while True:
+            if self._retry_at:
+                timeout = max(self._retry_at - time.monotonic(), 0)
+            else:
+                timeout = JOURNAL_POLL_INTERVAL
+            self._wake.wait(timeout)
+            self._wake.clear()
+            if self._retry_at and time.monotonic() < self._retry_at:
+                continue
+            urgent, self._urgent = self._urgent, False
+            try:
+                if urgent:
+                    self.flush_once()
+                else:
+                    with background_sheets():
+                        self.flush_once()
+                self.attempts = 0
+                self._retry_at = 0.0
+                record_dependency("journal")
+            except Exception as e:
+                self.attempts += 1
+                self.last_error = repr(e)
+                record_dependency("journal", e)
+                base = JOURNAL_QUOTA_RETRY_BASE if _is_quota_error(e) else JOURNAL_RETRY_BASE
+                delay = min(base * 2 ** (self.attempts - 1), JOURNAL_RETRY_MAX)
+                self._retry_at = time.monotonic() + delay
+                print(f"ERROR flushing write journal (retry in {delay}s):", repr(e))
+            with self._idle:
+                self._idle.notify_all()
+
+    def start(self):
+        if self._thread is None:
+            self.restore()
+            self._thread = threading.Thread(target=self._loop, name="write-journal", daemon=True)
+            self._thread.start()
+        return self._thread
+
+
+JOURNAL = WriteJournal(JOURNAL_DB_PATH)
+
+
+# ================== LOCAL SNAPSHOT ==================
+# لقطة محلية للدفتر والمواشي والميتا: تشغيل سريع وتقارير حتى لو Sheets غير متاح
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", "snapshot")
+SNAPSHOT_INTERVAL = int(os.environ.get("SNAPSHOT_INTERVAL", "300"))
+SNAPSHOT_VERSION = 1
+_SNAPSHOT_LOCK = threading.Lock()
+_SNAPSHOT_SAVED = {}  # اسم الملف → checksum آخر ما حفظناه
+
+
+def _checksum(value):
+    if not isinstance(value, bytes):
+        value = json.dumps(value, ensure_ascii=False).encode()
+    return hashlib.sha1(value).hexdigest()
+
+
+def _write_file(name, data: bytes):
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    path = os.path.join(SNAPSHOT_DIR, name)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _read_json(name):
+    path = os.path.join(SNAPSHOT_DIR, name)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return data if data.get("version") == SNAPSHOT_VERSION else None
+
+
+def _read_array(name, typecode):
+    """نقرأ مصفوفة رقمية من ملف ثنائي بدون تحليل نصوص؛ نرجع (array, checksum)."""
+    path = os.path.join(SNAPSHOT_DIR, name)
+    with open(path, "rb") as f:
+        data = f.read()
+    values = array.array(typecode)
+    values.frombytes(data)
+    return values, _checksum(data)
+
+
+def _ledger_columns(rows):
+    """أعمدة الدفتر: ordinal التاريخ (int32) والمبلغ (float64) لكل صف بيانات."""
+    ordinals = array.array("i")
+    amounts = array.array("d")
+    for row in rows[1:]:
+        e = _parse_expense_row(row)
+        ordinals.append(e.day if e is not None else 0)
+        signed = _signed_amount(row)
+        if signed is None:
+            amounts.append(float("nan"))
         else:
-            expense += amt
-            net -= amt
+            amounts.append(signed if row[1].strip() == "بيع" else -signed)
+    return ordinals, amounts
+
+
+def save_snapshot():
+    """نحفظ ما تغيّر فقط؛ ملف JSON يُكتب أخيراً ويحمل checksum كل الملفات."""
+    with _SNAPSHOT_LOCK:
+        rows = LEDGER.export_rows()
+        if rows is not None:
+            key = _checksum(rows)
+            if _SNAPSHOT_SAVED.get("ledger") != key:
+                ordinals, amounts = _ledger_columns(rows)
+                ord_bytes, amt_bytes = ordinals.tobytes(), amounts.tobytes()
+                _write_file("ledger.ordinal.i32", ord_bytes)
+                _write_file("ledger.amount.f64", amt_bytes)
+                width = max(len(r) for r in rows) if rows else LEDGER_COLS
+                columns = [[r[c] if c < len(r) else "" for r in rows] for c in range(width)]
+                meta = {
+                    "version": SNAPSHOT_VERSION,
+                    "rows": len(rows),
+                    "columns": columns,
+                    "checksum": key,
+                    "ordinal_checksum": _checksum(ord_bytes),
+                    "amount_checksum": _checksum(amt_bytes),
+                    "saved_at": time.time(),
+                }
+                _write_file("ledger.json", json.dumps(meta, ensure_ascii=False).encode())
+                _SNAPSHOT_SAVED["ledger"] = key
+
+        for name, value in (("livestock", LIVESTOCK.rows()), ("meta", META.export())):
+            if value is None:
+                continue
+            key = _checksum(value)
+            if _SNAPSHOT_SAVED.get(name) == key:
+                continue
+            data = {"version": SNAPSHOT_VERSION, "data": value, "saved_at": time.time()}
+            _write_file(f"{name}.json", json.dumps(data, ensure_ascii=False).encode())
+            _SNAPSHOT_SAVED[name] = key
 
-    return round(income, 2), round(expense, 2), round(net, 2)
 
+def load_snapshot():
+    """نحمّل اللقطة عند التشغيل؛ أي ملف تالف أو ناقص نتجاهله ونقرأ من Sheets."""
+    try:
+        meta = _read_json("ledger.json")
+        if meta is not None:
+            ordinals, ord_sum = _read_array("ledger.ordinal.i32", "i")
+            amounts, amt_sum = _read_array("ledger.amount.f64", "d")
+            rows = [list(r) for r in zip(*meta["columns"])]
+            if (
+                len(rows) == meta["rows"]
+                and len(ordinals) == len(amounts) == len(rows) - 1
+                and ord_sum == meta["ordinal_checksum"]
+                and amt_sum == meta["amount_checksum"]
+                and _checksum(rows) == meta["checksum"]
+            ):
+                LEDGER.load_snapshot(rows, ordinals, amounts)
+                _SNAPSHOT_SAVED["ledger"] = meta["checksum"]
+                print(f"Loaded ledger snapshot ({len(rows) - 1} rows)")
+            else:
+                print("WARNING ledger snapshot is inconsistent, ignoring it")
+    except Exception as e:
+        print("ERROR loading ledger snapshot:", repr(e))
 
-def answer_query_from_ai(update, ai_data, original_text):
+    for name, restore in (("livestock", LIVESTOCK.replace), ("meta", META.restore)):
+        try:
+            data = _read_json(f"{name}.json")
+            if data is not None:
+                restore(data["data"])
+                _SNAPSHOT_SAVED[name] = _checksum(data["data"])
+        except Exception as e:
+            print(f"ERROR loading {name} snapshot:", repr(e))
+
+
+def reconcile_snapshot():
+    """نقارن اللقطة مع Sheets (ذيل الدفتر، محتوى المواشي، الميتا) ثم نحفظ الفرق."""
+    with background_sheets():
+        for name, refresh in (
+            ("ledger", lambda: LEDGER.ensure_fresh(max_age=0)),
+            ("livestock", lambda: LIVESTOCK.ensure_fresh(max_age=0)),
+            ("meta", META.reload),
+        ):
+            try:
+                refresh()
+            except Exception as e:
+                print(f"ERROR reconciling {name} with Google Sheets:", repr(e))
     try:
-        expenses = load_expenses()
+        save_snapshot()
     except Exception as e:
-        update.message.reply_text(f"❌ خطأ في قراءة البيانات من Google Sheets:\n{e}")
-        return
+        print("ERROR saving snapshot:", repr(e))
 
-    today = datetime.now().date()
-    period = ai_data.get("query_period") or "all_time"
 
+def start_snapshot_sync():
+    """خيط خلفي: مطابقة فورية بعد التشغيل، ثم كل SNAPSHOT_INTERVAL ثانية نحفظ
+    فقط (كشف التغييرات يبقي الذاكرة مطابقة) أو نطابق إذا الكشف متوقف."""
+
+    def loop():
+        reconcile_snapshot()
+        while True:
+            time.sleep(SNAPSHOT_INTERVAL)
+            if not CHANGES.active():
+                reconcile_snapshot()
+                continue
+            try:
+                save_snapshot()
+            except Exception as e:
+                print("ERROR saving snapshot:", repr(e))
+
+    t = threading.Thread(target=loop, name="snapshot-sync", daemon=True)
+    t.start()
+    return t
+
+
+# ================== CHANGE DETECTION ==================
+# نراقب وقت آخر تعديل للملف (Drive modifiedTime) بدل إعادة القراءة كل فترة؛ 0 يعطّل
+CHANGE_POLL_INTERVAL = int(os.environ.get("CHANGE_POLL_INTERVAL", "15"))
+# فحص كامل دوري حتى لو لم يتغير الملف (يلتقط تعديلاً يدوياً تزامن مع كتاباتنا)
+CHANGE_FULL_CHECK_INTERVAL = int(os.environ.get("CHANGE_FULL_CHECK_INTERVAL", "3600"))
+
+
+class ChangeDetector:
+    """يكتشف التعديلات اليدوية في Google Sheets بنداء رخيص واحد كل فترة.
+
+    إذا لم يتغير modifiedTime فكل الكاش حديث. إذا تغيّر نفحص كل تبويب بأرخص
+    طريقة: الأعمدة A:E + الذيل للدفتر، المحتوى للمواشي (تبويب صغير)، عمود
+    رقم الصف للميتا. ما دام الكشف يعمل، الكاش لا ينتهي بالوقت.
+
+    كتابات البوت نفسه تغيّر modifiedTime أيضاً؛ كاتب السجل يحيطها بـ
+    begin_own_write/end_own_write فنعتمد الوقت الجديد بدون فحص التبويبات،
+    بشرط ألا يكون الملف تغيّر من خارجنا قبلها ولا فشل أي نداء أثناءها.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.last_modified = None
+        self.last_poll = None  # لا شيء قبل أول فحص ناجح
+        self.last_full_check = None
+        self.changes = 0
+        self.own_writes = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def active(self) -> bool:
+        return (
+            self._thread is not None
+            and self.last_poll is not None
+            and time.monotonic() - self.last_poll < 3 * self.interval
+        )
+
+    def poll(self):
+        # نقرأ الوقت قبل الفحص: أي تعديل أثناء الفحص يظهر في الدورة القادمة
+        modified = _sheets_call(_get_spreadsheet().get_lastUpdateTime)
+        now = time.monotonic()
+        with self._lock:
+            changed = modified != self.last_modified
+        full_due = (
+            self.last_full_check is None
+            or now - self.last_full_check >= CHANGE_FULL_CHECK_INTERVAL
+        )
+        if changed or full_due:
+            LEDGER.check_changes()
+            LIVESTOCK.ensure_fresh(max_age=0)
+            META.check_changes()
+            self.last_full_check = now
+            with self._lock:
+                if changed and self.last_modified is not None:
+                    self.changes += 1
+                self.last_modified = modified
+        LEDGER.mark_fresh()
+        LIVESTOCK.mark_fresh()
+        self.last_poll = time.monotonic()
+
+    def begin_own_write(self):
+        """قبل كتابات البوت؛ نرجع علامة أو None إذا لا يمكن اعتماد كتاباتنا وحدها."""
+        if not self.active():
+            return None
+        try:
+            modified = _sheets_call(_get_spreadsheet().get_lastUpdateTime)
+        except Exception as e:
+            print("ERROR reading modifiedTime before write:", repr(e))
+            return None
+        with self._lock:
+            if modified != self.last_modified:
+                # تعديل من خارجنا لم نفحصه بعد → الدورة القادمة تفحص
+                return None
+        with _SHEETS_STATS_LOCK:
+            errors = SHEETS_STATS["errors"]
+        return modified, errors
+
+    def end_own_write(self, token):
+        """بعد كتابات ناجحة: نعتمد modifiedTime الجديد كأنه مفحوص."""
+        if token is None:
+            return
+        modified, errors = token
+        with _SHEETS_STATS_LOCK:
+            if SHEETS_STATS["errors"] != errors:
+                return
+        try:
+            after = _sheets_call(_get_spreadsheet().get_lastUpdateTime)
+        except Exception as e:
+            print("ERROR reading modifiedTime after write:", repr(e))
+            return
+        with self._lock:
+            if self.last_modified == modified:
+                self.last_modified = after
+                self.own_writes += 1
+
+    def _loop(self):
+        while True:
+            try:
+                with background_sheets():
+                    self.poll()
+            except Exception as e:
+                print("ERROR checking Google Sheets for changes:", repr(e))
+            time.sleep(self.interval)
+
+    def start(self):
+        if self.interval > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="change-detector", daemon=True)
+            self._thread.start()
+        return self._thread
+
+
+CHANGES = ChangeDetector(CHANGE_POLL_INTERVAL)
+
+
+def _default_max_age(interval):
+    """مع كشف التغييرات تكون المزامنة مسؤوليته، وإلا نرجع لعمر الكاش."""
+    return float("inf") if CHANGES.active() else interval
+
+
+# ================== REPORT HELPERS ==================
+class ExpenseRecord:
+    """صف مصروف مضغوط يُبنى منه فهرس التقارير (new_ledger_index): اليوم كـ
+    ordinal، والفئات نصوص مُدمجة (sys.intern) فمفاتيح PeriodAggregator لنفس
+    process/type/item تشير لنفس الكائن."""
+
+    __slots__ = ("day", "amount", "process", "type", "item")
+
+    def __init__(self, day, amount, process, type_, item):
+        self.day = day
+        self.amount = amount
+        self.process = sys.intern(process)
+        self.type = sys.intern(type_)
+        self.item = sys.intern(item)
+
+    @property
+    def date(self):
+        return date.fromordinal(self.day)
+
+    def key(self):
+        return (self.day, self.amount, self.process, self.type, self.item)
+
+
+@functools.lru_cache(maxsize=8192)
+def _parse_day(date_str):
+    """ordinal لتاريخ بصيغة YYYY-MM-DD (أول 10 أحرف)، أو None. الدفتر يكرر نفس
+    التواريخ كثيراً فالكاش يوفر أغلب استدعاءات strptime."""
+    try:
+        return datetime.strptime(date_str, "%Y-%m-%d").toordinal()
+    except Exception:
+        return None
+
+
+def _parse_expense_row(row):
+    """نحول صف من Azba Expenses إلى ExpenseRecord، أو None إذا الصف ناقص."""
+    if len(row) < 5:
+        return None
+    date_str = row[0].strip()
+    process = row[1].strip() if len(row) > 1 and row[1] else ""
+    type_ = row[2].strip() if len(row) > 2 and row[2] else ""
+    item = row[3].strip() if len(row) > 3 and row[3] else ""
+    amount_str = row[4].strip()
+    if not date_str or not amount_str:
+        return None
+    day = _parse_day(date_str[:10])
+    if day is None:
+        return None
+    try:
+        amount = float(str(amount_str).replace(",", ""))
+    except Exception:
+        return None
+    return ExpenseRecord(day, amount, process, type_, item)
+
+
+class PeriodAggregator:
+    """تجميع يومي للدفتر حتى يكون أي مدى تاريخ مجرد بحث في مجاميع تراكمية.
+
+    لكل يوم (ordinal) نحفظ [الدخل, المصروف, العدد]، ولكل ثلاثية
+    (process, type, item) نحفظ [المجموع, العدد] لكل يوم. المجاميع التراكمية
+    تُبنى عند أول استعلام بعد أي تغيير.
+    """
+
+    def __init__(self):
+        self._days = {}
+        self._by_key = {}
+        self._totals = None
+        self._key_totals = {}
+
+    @classmethod
+    def from_expenses(cls, expenses):
+        agg = cls()
+        for e in expenses:
+            agg.add(e)
+        return agg
+
+    def add(self, e, sign=1):
+        """نضيف عملية (أو نطرحها مع sign=-1 عند التراجع)."""
+        day = e.day
+        amt = sign * e.amount
+        bucket = self._days.setdefault(day, [0.0, 0.0, 0])
+        if e.process == "بيع":
+            bucket[0] += amt
+        else:
+            bucket[1] += amt
+        bucket[2] += sign
+
+        key = (e.process, e.type, e.item)
+        key_bucket = self._by_key.setdefault(key, {}).setdefault(day, [0.0, 0])
+        key_bucket[0] += amt
+        key_bucket[1] += sign
+
+        self._totals = None
+        self._key_totals.pop(key, None)
+
+    @staticmethod
+    def _cumulate(buckets, width):
+        days = sorted(buckets)
+        cums = [[0] * (len(days) + 1) for _ in range(width)]
+        for i, day in enumerate(days):
+            values = buckets[day]
+            for k in range(width):
+                cums[k][i + 1] = cums[k][i] + values[k]
+        return days, cums
+
+    @staticmethod
+    def _window(days, start_date, end_date):
+        lo = bisect.bisect_left(days, start_date.toordinal())
+        hi = bisect.bisect_right(days, end_date.toordinal())
+        return lo, max(lo, hi)
+
+    def summarize(self, start_date, end_date):
+        """(الدخل, المصروف, الصافي) بين تاريخين شاملين."""
+        if self._totals is None:
+            self._totals = self._cumulate(self._days, 3)
+        days, (cum_in, cum_out, _) = self._totals
+        lo, hi = self._window(days, start_date, end_date)
+        income = cum_in[hi] - cum_in[lo]
+        expense = cum_out[hi] - cum_out[lo]
+        return round(income, 2), round(expense, 2), round(income - expense, 2)
+
+    def summarize_windows(self, windows):
+        """كل النوافذ من نفس المجاميع التراكمية: بحثان ثنائيان لكل نافذة."""
+        return {name: self.summarize(start, end) for name, (start, end) in windows.items()}
+
+    def query(self, start_date, end_date, process=None, type_=None, item=None):
+        """(المجموع, العدد) للعمليات المطابقة للفلاتر بين تاريخين."""
+        total = 0.0
+        count = 0
+        for key, buckets in self._by_key.items():
+            k_process, k_type, k_item = key
+            if process and k_process != process:
+                continue
+            if type_ and k_type != type_:
+                continue
+            if item and item not in (k_item or ""):
+                continue
+            if key not in self._key_totals:
+                self._key_totals[key] = self._cumulate(buckets, 2)
+            days, (cum_total, cum_count) = self._key_totals[key]
+            lo, hi = self._window(days, start_date, end_date)
+            total += cum_total[hi] - cum_total[lo]
+            count += cum_count[hi] - cum_count[lo]
+        return round(total, 2), count
+
+
+# "numpy" لدفاتر كبيرة (يحتاج numpy مثبت)، وإلا التجميع اليومي العادي
+LEDGER_BACKEND = os.environ.get("LEDGER_BACKEND", "python")
+
+
+class NumpyLedgerIndex:
+    """بديل PeriodAggregator بمصفوفات NumPy: عمود للتاريخ (ordinal) وعمود للمبلغ
+    وترميز فئوي لـ process/type/item، والتقارير عمليات على المصفوفات.
+
+    الجمع يتم بـ np.add.accumulate (تسلسلي بترتيب الصفوف في الورقة) وليس
+    np.sum (جمع زوجي)، فالنتائج مطابقة تماماً للجمع صفاً صفاً.
+    """
+
+    def __init__(self, days, amounts, process, type_, item):
+        self._days = np.asarray(days, dtype=np.int32)
+        self._amounts = np.asarray(amounts, dtype=np.float64)
+        self._codes = {}
+        self._labels = {}
+        for name, values in (("process", process), ("type", type_), ("item", item)):
+            codes = {}
+            self._codes[name] = np.fromiter(
+                (codes.setdefault(v, len(codes)) for v in values),
+                dtype=np.int32,
+                count=len(values),
+            )
+            self._labels[name] = codes
+        self._sale = self._codes["process"] == self._labels["process"].get("بيع", -1)
+        self._pending = []  # (e, sign) تُدمج في المصفوفات عند أول استعلام
+
+    @classmethod
+    def from_columns(cls, rows, ordinals, amounts):
+        """rows بدون العناوين، مع أعمدة _ledger_columns (ordinal=0 → خارج التقارير)."""
+        ordinals = np.frombuffer(ordinals, dtype=np.int32) if len(ordinals) else np.zeros(0, np.int32)
+        amounts = np.frombuffer(amounts, dtype=np.float64) if len(amounts) else np.zeros(0)
+        keep = np.flatnonzero(ordinals)
+        picked = [rows[i] for i in keep.tolist()]
+        return cls(
+            ordinals[keep],
+            amounts[keep],
+            [r[1].strip() for r in picked],
+            [r[2].strip() for r in picked],
+            [r[3].strip() for r in picked],
+        )
+
+    @classmethod
+    def from_rows(cls, rows):
+        ordinals, amounts = _ledger_columns([[]] + list(rows))
+        return cls.from_columns(rows, ordinals, amounts)
+
+    def add(self, e, sign=1):
+        self._pending.append((e, sign))
+
+    def _merge_pending(self):
+        if not self._pending:
+            return
+        days = self._days.tolist()
+        amounts = self._amounts.tolist()
+        columns = {}
+        for name, codes in self._labels.items():
+            labels = list(codes)
+            columns[name] = [labels[c] for c in self._codes[name].tolist()]
+        for e, sign in self._pending:
+            values = e.key()
+            if sign > 0:
+                days.append(values[0])
+                amounts.append(values[1])
+                for name, v in zip(("process", "type", "item"), values[2:]):
+                    columns[name].append(v)
+                continue
+            # تراجع: نحذف آخر صف مطابق
+            for i in range(len(days) - 1, -1, -1):
+                row = (days[i], amounts[i], columns["process"][i], columns["type"][i], columns["item"][i])
+                if row == values:
+                    del days[i], amounts[i]
+                    for name in columns:
+                        del columns[name][i]
+                    break
+        self.__init__(days, amounts, columns["process"], columns["type"], columns["item"])
+
+    @staticmethod
+    def _sequential_sum(values):
+        return float(np.add.accumulate(values)[-1]) if len(values) else 0.0
+
+    def _window(self, start_date, end_date):
+        return (self._days >= start_date.toordinal()) & (self._days <= end_date.toordinal())
+
+    def summarize(self, start_date, end_date):
+        """(الدخل, المصروف, الصافي) بين تاريخين شاملين."""
+        return self.summarize_windows({"period": (start_date, end_date)})["period"]
+
+    def summarize_windows(self, windows):
+        self._merge_pending()
+        signed = np.where(self._sale, self._amounts, -self._amounts)
+        out = {}
+        for name, (start_date, end_date) in windows.items():
+            window = self._window(start_date, end_date)
+            income = self._sequential_sum(self._amounts[window & self._sale])
+            expense = self._sequential_sum(self._amounts[window & ~self._sale])
+            net = self._sequential_sum(signed[window])
+            out[name] = (round(income, 2), round(expense, 2), round(net, 2))
+        return out
+
+    def query(self, start_date, end_date, process=None, type_=None, item=None):
+        """(المجموع, العدد) للعمليات المطابقة للفلاتر بين تاريخين."""
+        self._merge_pending()
+        mask = self._window(start_date, end_date)
+        if process:
+            mask &= self._codes["process"] == self._labels["process"].get(process, -1)
+        if type_:
+            mask &= self._codes["type"] == self._labels["type"].get(type_, -1)
+        if item:
+            matching = [c for label, c in self._labels["item"].items() if item in (label or "")]
+            mask &= np.isin(self._codes["item"], matching)
+        return round(self._sequential_sum(self._amounts[mask]), 2), int(mask.sum())
+
+
+def new_ledger_index(rows=None, ordinals=None, amounts=None):
+    """فهرس التقارير حسب LEDGER_BACKEND؛ rows بدون العناوين."""
+    rows = rows or []
+    if LEDGER_BACKEND == "numpy" and np is not None:
+        if ordinals is not None:
+            return NumpyLedgerIndex.from_columns(rows, ordinals, amounts)
+        return NumpyLedgerIndex.from_rows(rows)
+    expenses = (_parse_expense_row(r) for r in rows)
+    return PeriodAggregator.from_expenses(e for e in expenses if e)
+
+
+def period_range(period, today=None):
+    """نرجع (البداية, النهاية, الوصف) لقيمة query_period."""
+    today = today or datetime.now().date()
     if period == "today":
-        start = end = today
-        period_label = "اليوم"
-    elif period == "yesterday":
+        return today, today, "اليوم"
+    if period == "yesterday":
         d = today - timedelta(days=1)
-        start = end = d
-        period_label = "أمس"
-    elif period in ("this_week", "last_7_days"):
-        start = today - timedelta(days=6)
-        end = today
-        period_label = "آخر 7 أيام"
-    elif period == "this_month":
-        start = datetime(today.year, today.month, 1).date()
-        end = today
-        period_label = "هذا الشهر"
-    else:
-        start = datetime(1970, 1, 1).date()
-        end = today
-        period_label = "كل الفترة"
+        return d, d, "أمس"
+    if period in ("this_week", "last_7_days"):
+        return today - timedelta(days=6), today, "آخر 7 أيام"
+    if period == "this_month":
+        return today.replace(day=1), today, "هذا الشهر"
+    if period == "last_month":
+        end = today.replace(day=1) - timedelta(days=1)
+        return end.replace(day=1), end, "الشهر الماضي"
+    if period == "this_year":
+        return today.replace(month=1, day=1), today, "هذه السنة"
+    return datetime(1970, 1, 1).date(), today, "كل الفترة"
+
+
+def report_windows(periods, today=None):
+    """{period: (بداية, نهاية)} لقيم query_period، لتمريرها إلى LEDGER.summarize_windows."""
+    today = today or datetime.now().date()
+    return {p: period_range(p, today)[:2] for p in periods}
+
+
+def _summary_lines(title, summary):
+    income, expense, net = summary
+    return f"{title}:\nالدخل: +{income}\nالمصاريف: -{expense}\nالصافي: {net:+}"
+
+
+def answer_query_from_ai(update, ai_data, original_text):
+    period = ai_data.get("query_period") or "all_time"
+    start, end, period_label = period_range(period)
 
     q_process = ai_data.get("query_process") or None
     q_type = ai_data.get("query_type") or None
     q_item = ai_data.get("query_item") or None
 
-    total = 0.0
-    count = 0
+    try:
+        total, count = LEDGER.query(
+            start, end, process=q_process, type_=q_type, item=q_item
+        )
+    except Exception as e:
+        update.message.reply_text(f"❌ خطأ في قراءة البيانات من Google Sheets:\n{e}")
+        return
 
-    for e in expenses:
-        if not (start <= e["date"] <= end):
-            continue
-        if q_process and e["process"] != q_process:
-            continue
-        if q_type and e.get("type") != q_type:
+    if q_process == "شراء":
+        proc_txt = "المشتريات"
+    elif q_process == "بيع":
+        proc_txt = "المبيعات"
+    elif q_process:
+        proc_txt = f"عمليات {q_process}"
+    else:
+        proc_txt = "العمليات"
+
+    detail_txt = ""
+    if q_item:
+        detail_txt = f" لـ {q_item}"
+    elif q_type and q_type != "اخرى":
+        detail_txt = f" ({q_type})"
+
+    update.message.reply_text(
+        "📊 نتيجة سؤالك:\n"
+        f"إجمالي {proc_txt}{detail_txt} في {period_label}: {total}\n"
+        f"عدد العمليات المحسوبة: {count}"
+    )
+
+
+# ================== FAST PATH PARSER ==================
+# رسائل معتادة نفهمها محلياً بدون الذكاء الاصطناعي؛ الباقي يروح لـ analyze_with_ai
+FAST_PATH_ENABLED = os.environ.get("FAST_PATH_ENABLED", "1") != "0"
+FAST_PATH_MIN_CONFIDENCE = float(os.environ.get("FAST_PATH_MIN_CONFIDENCE", "0.85"))
+
+_FAST_PROCESS_WORDS = {
+    "شراء": ["شريت", "اشتريت", "شرينا", "اشترينا", "شراء"],
+    "فاتورة": ["فاتورة", "فواتير"],
+    "راتب": ["راتب", "رواتب", "معاش"],
+}
+_FAST_TYPE_WORDS = {
+    "علف": ["علف", "اعلاف", "برسيم", "شعير", "تبن", "رودس", "نخاله"],
+    "علاج": ["علاج", "دواء", "دوا", "ادوية", "تطعيم", "بيطري"],
+    "كهرباء": ["كهرباء", "كهربا"],
+    "ماء": ["ماء", "مويه", "ماي"],
+    "عمال": ["عامل", "عمال", "راعي", "الراعي"],
+}
+_FAST_ANIMAL_WORDS = {
+    "غنم": ["غنم", "خروف", "خرفان", "نعجة", "نعاج"],
+    "أبقار": ["بقر", "بقرة", "أبقار"],
+    "ثور": ["ثور", "ثيران"],
+    "جمال": ["جمل", "جمال", "ناقة", "نوق", "بعير"],
+    "ماعز": ["ماعز", "عنز", "تيس", "تيوس"],
+}
+# السلالة → نوع الحيوان الافتراضي (None = لازم يُذكر النوع صراحة)
+_FAST_BREED_WORDS = {
+    "حري": (["حري"], "غنم"),
+    "سوري": (["سوري"], "غنم"),
+    "صومالي": (["صومالي"], "غنم"),
+    "صلالي": (["صلالي"], None),
+    "اضاحي": (["اضاحي", "أضاحي", "اضحية"], "غنم"),
+}
+_FAST_MOVEMENT_WORDS = {
+    "بيع": ["بعت", "بعنا", "بيع"],
+    "نفوق": ["نفق", "نفقت", "نافق", "مات", "ماتت"],
+    "مواليد": ["ولدت", "مواليد", "مولود", "ولادة"],
+    "إضافة": ["اضافة", "زيادة", "شريت", "اشتريت"],
+    "نقص": ["نقص", "ناقص", "ضاع", "ضاعت"],
+}
+# صرفت/دفعت تشمل الفواتير والرواتب أيضاً → بدون عملية محددة (query_process = null)
+_FAST_ANY_PROCESS = ""
+_FAST_QUERY_WORDS = {
+    "شراء": ["شريت", "اشتريت"],
+    "بيع": ["بعت", "بعنا", "ربحت", "دخل", "دخلت"],
+    _FAST_ANY_PROCESS: ["صرفت", "صرفنا", "دفعت"],
+}
+_FAST_PERIOD_WORDS = {
+    "today": ["اليوم"],
+    "yesterday": ["امس"],
+    "last_7_days": ["اسبوع", "الاسبوع"],
+    "this_month": ["الشهر", "شهر"],
+    "this_year": ["السنة", "سنة", "العام"],
+}
+_FAST_STATUS_WORDS = ["كشف", "حالة", "عدد", "اعداد", "مواشي", "المواشي", "الحلال", "عندي"]
+_FAST_FILLER_WORDS = [
+    "ب", "بمبلغ", "على", "عل", "من", "في", "هذا", "هذه", "ذا", "و", "لل", "حق",
+    "كم", "درهم", "ريال", "راس", "رؤوس", "لي", "اعطني", "عطني", "قبل", "كل",
+    "المجموع", "مجموع", "اجمالي", "الماضي", "السابق",
+]
+# كلمات تعني حصر كامل أو صياغة نتركها للذكاء الاصطناعي دائماً
+_FAST_DEFER_WORDS = ["سجل", "حصر", "الكلي", "كالتالي", "الف", "الاف", "مليون"]
+
+_FAST_PREFIXES = ("وال", "بال", "لل", "ال", "و", "ب", "ل")
+_ARABIC_DIGITS = str.maketrans("٠١٢٣٤٥٦٧٨٩", "0123456789")
+_NUMBER_RE = r"\d+(?:[.,]\d+)*"
+
+FAST_PATH_STATS = {"hits": 0, "misses": 0}
+_FAST_PATH_STATS_LOCK = threading.Lock()
+_FAST_VOCAB = None
+
+
+def _fast_vocab():
+    """نبني جداول الكلمات (بعد _norm_arabic) مرة واحدة."""
+    global _FAST_VOCAB
+    if _FAST_VOCAB is None:
+
+        def table(mapping):
+            out = {}
+            for value, words in mapping.items():
+                for w in words:
+                    out.setdefault(_norm_arabic(w), value)
+            return out
+
+        _FAST_VOCAB = {
+            "process": table(_FAST_PROCESS_WORDS),
+            "type": table(_FAST_TYPE_WORDS),
+            "animal": table(_FAST_ANIMAL_WORDS),
+            "breed": table({b: words for b, (words, _) in _FAST_BREED_WORDS.items()}),
+            "movement": table(_FAST_MOVEMENT_WORDS),
+            "query": table(_FAST_QUERY_WORDS),
+            "period": table(_FAST_PERIOD_WORDS),
+            "status": {_norm_arabic(w): True for w in _FAST_STATUS_WORDS},
+            "filler": {_norm_arabic(w): True for w in _FAST_FILLER_WORDS},
+            "defer": {_norm_arabic(w): True for w in _FAST_DEFER_WORDS},
+        }
+    return _FAST_VOCAB
+
+
+def _parse_number(s):
+    if re.fullmatch(r"\d{1,3}(,\d{3})+(\.\d+)?", s):
+        return float(s.replace(",", ""))
+    try:
+        return float(s.replace(",", "."))
+    except ValueError:
+        return None
+
+
+def _fast_tokens(text):
+    """نقسم الرسالة إلى ("num", قيمة) أو ("word", كلمة مطبّعة)."""
+    text = text.translate(_ARABIC_DIGITS)
+    text = re.sub(f"({_NUMBER_RE})", r" \1 ", text)
+    tokens = []
+    for raw in text.split():
+        if re.fullmatch(_NUMBER_RE, raw):
+            value = _parse_number(raw)
+            if value is not None:
+                tokens.append(("num", value))
             continue
-        if q_item and q_item not in (e.get("item") or ""):
+        word = _norm_arabic(raw)
+        if word:
+            tokens.append(("word", word))
+    return tokens
+
+
+def _fast_lookup(word, kind):
+    """نبحث عن الكلمة كما هي ثم بعد حذف السوابق (و، ب، ال...)."""
+    table = _fast_vocab()[kind]
+    if word in table:
+        return table[word]
+    for prefix in _FAST_PREFIXES:
+        if word.startswith(prefix) and len(word) - len(prefix) >= 2:
+            stem = word[len(prefix):]
+            if stem in table:
+                return table[stem]
+    return None
+
+
+def _empty_intent(intent):
+    return {
+        "intent": intent,
+        "date": None,
+        "process": None,
+        "type": None,
+        "item": None,
+        "amount": None,
+        "note": None,
+        "query_period": None,
+        "query_process": None,
+        "query_type": None,
+        "query_item": None,
+        "livestock_entries": [],
+        "livestock_status_target": intent == "livestock_status",
+    }
+
+
+def _single_item(item_words):
+    """كلمات البند متجاورة وبدون "و" بينها (شعير وبرسيم = بندان)."""
+    for (i, _), (j, word) in zip(item_words, item_words[1:]):
+        if j != i + 1 or (word.startswith("و") and word not in _fast_vocab()["type"]):
+            return False
+    return True
+
+
+def fast_parse(text):
+    """تحليل محلي للرسائل المعتادة.
+
+    نرجع (dict بنفس شكل analyze_with_ai, الثقة من 0 إلى 1)، أو (None, 0.0)
+    إذا الرسالة ليست من الأنماط المعروفة. الثقة = نسبة الكلمات المعروفة.
+    """
+    if not isinstance(text, str) or not text.strip():
+        return None, 0.0
+    # تواريخ صريحة مثل 12/5 تختلط مع المبالغ → نتركها للذكاء الاصطناعي
+    if re.search(r"\d{1,4}\s*[/-]\s*\d{1,2}", text.translate(_ARABIC_DIGITS)):
+        return None, 0.0
+
+    tokens = _fast_tokens(text)
+    if not tokens:
+        return None, 0.0
+
+    known = 0
+    nums = []
+    amount = None
+    processes, types, animals, breeds, movements = [], [], [], [], []
+    query_processes, periods, status_hits = [], [], 0
+    item_words = []
+    question = "?" in text or "؟" in text
+    day_shift = 0
+
+    for i, (kind, value) in enumerate(tokens):
+        if kind == "num":
+            known += 1
+            nums.append((i, value))
+            prev = tokens[i - 1] if i > 0 else None
+            if prev and prev[0] == "word" and prev[1] in ("ب", "بمبلغ"):
+                amount = value
             continue
-        total += e["amount"]
-        count += 1
 
-    if q_process == "شراء":
-        proc_txt = "المشتريات"
-    elif q_process == "بيع":
-        proc_txt = "المبيعات"
-    elif q_process:
-        proc_txt = f"عمليات {q_process}"
-    else:
-        proc_txt = "العمليات"
+        word = value
+        if _fast_lookup(word, "defer"):
+            return None, 0.0
+        hits = {
+            k: _fast_lookup(word, k)
+            for k in ("process", "type", "animal", "breed", "movement", "query", "period")
+        }
+        is_status = bool(_fast_lookup(word, "status"))
+        is_filler = bool(_fast_lookup(word, "filler"))
+        if word == "كم":
+            question = True
+        if word == "امس":
+            day_shift = 2 if i > 0 and tokens[i - 1] == ("word", "قبل") else 1
+
+        if hits["process"]:
+            processes.append(hits["process"])
+        if hits["type"]:
+            types.append(hits["type"])
+            item_words.append((i, word))
+        if hits["animal"]:
+            animals.append((i, hits["animal"]))
+        if hits["breed"]:
+            breeds.append((i, hits["breed"]))
+        if hits["movement"]:
+            movements.append((i, hits["movement"]))
+        if hits["query"] is not None:
+            query_processes.append(hits["query"])
+        if hits["period"]:
+            periods.append(hits["period"])
+        if is_status:
+            status_hits += 1
+
+        if any(v is not None for v in hits.values()) or is_status or is_filler:
+            known += 1
+
+    confidence = known / len(tokens)
+    today = datetime.now().date()
+    has_livestock_words = bool(animals or breeds)
+
+    # 1) كشف المواشي
+    if status_hits >= 2 and not nums and not processes and not movements:
+        return _empty_intent("livestock_status"), confidence
+
+    # 2) سؤال مالي: كم صرفت على العلف هذا الشهر
+    if question:
+        # مبلغ في سؤال (شريت علف بـ 1000؟) غالباً عملية وليس استعلام → للذكاء الاصطناعي
+        if nums or amount is not None:
+            return None, 0.0
+        if has_livestock_words or len(set(query_processes)) != 1 or len(set(types)) > 1:
+            return None, 0.0
+        if len(set(periods)) > 1:
+            return None, 0.0
+        period = periods[0] if periods else "all_time"
+        if "الماضي" in text or "السابق" in text:
+            if period != "this_month":
+                return None, 0.0
+            period = "last_month"
+        data = _empty_intent("financial_query")
+        data["query_period"] = period
+        data["query_process"] = query_processes[0] or None
+        data["query_type"] = types[0] if types else None
+        return data, confidence
+
+    # 3) عملية مالية بدون مواشي: شريت علف بـ 1000
+    if processes and not has_livestock_words:
+        # أكثر من مبلغ أو بند (شريت شعير بـ 200 و برسيم بـ 300) → للذكاء الاصطناعي
+        if len(nums) > 1 or not _single_item(item_words):
+            return None, 0.0
+        if amount is None and len(nums) == 1:
+            amount = nums[0][1]
+        if amount is None or amount <= 0 or len(set(types)) != 1 or len(set(processes)) != 1:
+            return None, 0.0
+        data = _empty_intent("expense_create")
+        data["date"] = (today - timedelta(days=day_shift)).isoformat()
+        data["process"] = processes[0]
+        data["type"] = types[0]
+        data["item"] = " ".join(word for _, word in item_words)
+        data["amount"] = amount
+        return data, confidence
+
+    # 4) تعديل أعداد المواشي بدون مبلغ: نفق 2 حري، بعت 3 حري و2 صومالي
+    if movements and has_livestock_words and amount is None and nums:
+        movement_at = dict(movements)
+        animal_at = dict(animals)
+        breed_at = dict(breeds)
+        entries = []
+        movement = None
+        for i, (kind, value) in enumerate(tokens):
+            if i in movement_at:
+                movement = movement_at[i]
+            if kind != "num":
+                continue
+            # العدد يتبعه نوع و/أو سلالة (كلمتين على الأكثر)
+            animal_type = breed = None
+            for j in (i + 1, i + 2):
+                animal_type = animal_type or animal_at.get(j)
+                breed = breed or breed_at.get(j)
+            if movement is None or (animal_type is None and breed is None):
+                return None, 0.0
+            if value != int(value) or value <= 0:
+                return None, 0.0
+            if animal_type is None:
+                animal_type = _FAST_BREED_WORDS[breed][1]
+                if animal_type is None:
+                    return None, 0.0
+            entries.append(
+                {
+                    "animal_type": animal_type,
+                    "breed": breed or "اخرى",
+                    "count": int(value),
+                    "movement": movement,
+                }
+            )
+        if not entries:
+            return None, 0.0
+        data = _empty_intent("livestock_change")
+        data["date"] = (today - timedelta(days=day_shift)).isoformat()
+        data["livestock_entries"] = entries
+        return data, confidence
+
+    return None, 0.0
+
+
+def _count_fast_path(hit: bool):
+    with _FAST_PATH_STATS_LOCK:
+        FAST_PATH_STATS["hits" if hit else "misses"] += 1
+
+
+def fast_path_hit_rate() -> float:
+    with _FAST_PATH_STATS_LOCK:
+        total = FAST_PATH_STATS["hits"] + FAST_PATH_STATS["misses"]
+        return FAST_PATH_STATS["hits"] / total if total else 0.0
+
+
+def classify_message(text):
+    """نجرب المحلل المحلي أولاً، ونستدعي الذكاء الاصطناعي فقط إذا كانت الرسالة غامضة."""
+    if FAST_PATH_ENABLED:
+        data, confidence = fast_parse(text)
+        if data is not None and confidence >= FAST_PATH_MIN_CONFIDENCE:
+            _count_fast_path(True)
+            print(f"FAST_PATH hit (confidence={confidence:.2f}, rate={fast_path_hit_rate():.2f})")
+            return data
+        _count_fast_path(False)
+    return analyze_with_ai_cached(text)
+
+
+# ================== PENDING CONFIRMATIONS ==================
+# آخر رسالة تنتظر /confirm لكل مستخدم، محفوظة في SQLite حتى تبقى بعد إعادة التشغيل
+PENDING_DB_PATH = os.environ.get("PENDING_DB_PATH", "pending.sqlite3")
+PENDING_TTL_SECONDS = int(os.environ.get("PENDING_TTL_SECONDS", "1800"))
+
+
+class PendingStore:
+    """عمليات تنتظر التأكيد: { user_id: {"text", "ai", "payload"} } مع مدة صلاحية.
+
+    الصلاحية تُفحص عند القراءة (lazy expiry)، وكل الوصول محمي بقفل لأن
+    الأوامر تأتي من خيوط مختلفة.
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _db(self):
+        """الاتصال يُفتح عند أول استخدام (وليس عند الاستيراد)؛ يُستدعى تحت self._lock."""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS pending ("
+                " user_id INTEGER PRIMARY KEY,"
+                " expires_at REAL NOT NULL,"
+                " entry TEXT NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+
+    def open(self):
+        with self._lock:
+            self._db()
+
+    def put(self, user_id, entry):
+        data = json.dumps(entry, ensure_ascii=False)
+        with self._lock:
+            # تنظيف المنتهية هنا (مسار كتابة) وليس في size() التي يستدعيها /health
+            self._db().execute("DELETE FROM pending WHERE expires_at < ?", (time.time(),))
+            self._db().execute(
+                "INSERT OR REPLACE INTO pending (user_id, expires_at, entry) VALUES (?, ?, ?)",
+                (user_id, time.time() + self.ttl, data),
+            )
+
+    def take(self, user_id):
+        """نسحب العملية المعلقة؛ نرجع (entry, expired)."""
+        with self._lock:
+            row = self._db().execute(
+                "SELECT expires_at, entry FROM pending WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if row is None:
+                return None, False
+            self._db().execute("DELETE FROM pending WHERE user_id = ?", (user_id,))
+        expires_at, data = row
+        if expires_at < time.time():
+            return None, True
+        return json.loads(data), False
 
-    detail_txt = ""
-    if q_item:
-        detail_txt = f" لـ {q_item}"
-    elif q_type and q_type != "اخرى":
-        detail_txt = f" ({q_type})"
+    def discard(self, user_id) -> bool:
+        """نحذف العملية المعلقة (إن وجدت وغير منتهية)."""
+        entry, _ = self.take(user_id)
+        return entry is not None
 
-    update.message.reply_text(
-        "📊 نتيجة سؤالك:\n"
-        f"إجمالي {proc_txt}{detail_txt} في {period_label}: {total}\n"
-        f"عدد العمليات المحسوبة: {count}"
-    )
+    def size(self) -> int:
+        with self._lock:
+            return self._db().execute(
+                "SELECT COUNT(*) FROM pending WHERE expires_at >= ?", (time.time(),)
+            ).fetchone()[0]
 
 
-# ================== PREVIEW MESSAGE ==================
-def send_preview_message(update, user_id, text, ai_data):
-    intent = ai_data.get("intent") or "other"
+PENDING = PendingStore(PENDING_DB_PATH, PENDING_TTL_SECONDS)
 
-    date_str = choose_date_from_ai(ai_data.get("date"), text)
-    process = ai_data.get("process") or "أخرى"
-    type_ = ai_data.get("type") or "اخرى"
-    item = ai_data.get("item") or ""
-    amount = ai_data.get("amount")
 
+def _amount_from(ai_data, text):
+    amount = ai_data.get("amount")
     if amount is None:
         m = re.search(r"(\d+(?:[.,]\d+)?)", text)
         if m:
@@ -602,17 +3303,62 @@ def send_preview_message(update, user_id, text, ai_data):
                 amount = abs(amount)
     except Exception:
         amount = None
+    return amount
+
+
+def build_write_payload(update, user_id, text, ai_data):
+    """نحسب وقت المعاينة كل ما سيكتبه /confirm (التاريخ، المبلغ، البنود...)."""
+    intent = ai_data.get("intent") or "other"
+    payload = {
+        "intent": intent,
+        "date": choose_date_from_ai(ai_data.get("date"), text),
+    }
+    entries = valid_livestock_entries(ai_data.get("livestock_entries"))
+
+    if intent == "livestock_baseline":
+        payload["rows"] = [[e["animal_type"], e["breed"], e["count"]] for e in entries]
+    elif intent == "livestock_change":
+        payload["livestock"] = entries
+    elif intent == "expense_create":
+        payload.update(
+            process=ai_data.get("process") or "أخرى",
+            type=ai_data.get("type") or "اخرى",
+            item=ai_data.get("item") or "",
+            amount=_amount_from(ai_data, text),
+            note=ai_data.get("note") or text,
+            person=USER_NAMES.get(
+                user_id, update.message.from_user.first_name or "مستخدم"
+            ),
+            livestock=entries,
+        )
+        try:
+            payload["prev_balance"] = compute_previous_balance()
+        except Exception:
+            payload["prev_balance"] = None
+    return payload
+
 
-    person_name = USER_NAMES.get(
+def set_pending(update, user_id, text, ai_data):
+    payload = build_write_payload(update, user_id, text, ai_data)
+    PENDING.put(user_id, {"text": text, "ai": ai_data, "payload": payload})
+    return payload
+
+
+# ================== PREVIEW MESSAGE ==================
+def send_preview_message(update, user_id, text, ai_data, payload):
+    intent = ai_data.get("intent") or "other"
+
+    date_str = payload["date"]
+    process = payload.get("process") or "أخرى"
+    type_ = payload.get("type") or "اخرى"
+    item = payload.get("item") or ""
+    amount = payload.get("amount")
+    person_name = payload.get("person") or USER_NAMES.get(
         user_id, update.message.from_user.first_name or "مستخدم"
     )
 
-    # حساب الرصيد المتوقع
-    try:
-        sheet = get_expense_sheet()
-        prev_balance = compute_previous_balance(sheet)
-    except Exception:
-        prev_balance = None
+    # الرصيد المتوقع (محسوب مسبقاً في payload)
+    prev_balance = payload.get("prev_balance")
 
     balance_preview = "سيتم حسابه عند الحفظ"
     if intent == "expense_create" and amount is not None and prev_balance is not None:
@@ -637,8 +3383,7 @@ def send_preview_message(update, user_id, text, ai_data):
             count_val = None
         if count_val is None:
             continue
-        minus_moves = {"بيع", "نقص", "نفوق"}
-        sign = "-" if movement in minus_moves else "+"
+        sign = "-" if movement in MINUS_MOVES else "+"
         livestock_preview_lines.append(
             f"{animal_type} | {breed} | الحركة: {movement} | التغيير: {sign}{count_val}"
         )
@@ -745,8 +3490,10 @@ def cancel_command(update, context):
         update.message.reply_text("❌ غير مصرح لك")
         return
 
-    if user_id in PENDING_MESSAGES:
-        del PENDING_MESSAGES[user_id]
+    # نلغي أيضاً أي رسالة ما زالت في الطابور أو قيد التحليل
+    dropped = USER_LANES.cancel_pending(user_id)
+    in_flight = _bump_cancel_generation(user_id)
+    if PENDING.discard(user_id) or dropped or in_flight:
         update.message.reply_text("❌ تم إلغاء العملية، لن يتم حفظ شيء.")
     else:
         update.message.reply_text("ℹ️ لا توجد عملية قيد التأكيد حالياً.")
@@ -758,179 +3505,100 @@ def confirm_command(update, context):
         update.message.reply_text("❌ غير مصرح لك")
         return
 
-    pending = PENDING_MESSAGES.get(user_id)
+    pending, expired = PENDING.take(user_id)
     if not pending:
-        update.message.reply_text("ℹ️ لا توجد رسالة قيد التأكيد. أرسل رسالة جديدة أولاً.")
+        if expired:
+            update.message.reply_text(
+                "⌛ انتهت صلاحية العملية المعلقة، أرسل الرسالة مرة أخرى حتى تُحسب على آخر بيانات."
+            )
+        else:
+            update.message.reply_text("ℹ️ لا توجد رسالة قيد التأكيد. أرسل رسالة جديدة أولاً.")
         return
 
-    text = pending["text"]
-    ai_data = pending.get("ai") or {}
-    intent = ai_data.get("intent") or "other"
-
-    # نزيلها من pending فوراً
-    del PENDING_MESSAGES[user_id]
+    payload = pending.get("payload") or {}
+    intent = payload.get("intent") or "other"
+    date_str = payload.get("date")
 
     # ========= 1) حصر كامل للمواشي =========
     if intent == "livestock_baseline":
-        livestock_entries = ai_data.get("livestock_entries") or []
-        if not isinstance(livestock_entries, list) or not livestock_entries:
-            update.message.reply_text("❌ لا توجد بيانات مواشي صالحة للحفظ.")
+        rows = payload.get("rows") or []
+        if not rows:
+            update.message.reply_text(
+                "❌ لم يتم حفظ أي بند، تأكد من صياغة رسالة الحصر."
+            )
             return
 
-        date_str = choose_date_from_ai(ai_data.get("date"), text)
-
         try:
-            sheet = get_livestock_summary_sheet()
-            sheet.clear()
-            sheet.append_row(
-                ["نوع الحيوان", "السلالة", "العدد الحالي"],
-                value_input_option="USER_ENTERED",
-            )
-
-            saved = 0
-            for e in livestock_entries:
-                animal_type = e.get("animal_type") or ""
-                breed = e.get("breed") or ""
-                count = e.get("count")
-                try:
-                    count_val = int(float(count)) if count is not None else None
-                except Exception:
-                    count_val = None
-                if count_val is None or count_val <= 0:
-                    continue
-                sheet.append_row(
-                    [animal_type, breed, count_val],
-                    value_input_option="USER_ENTERED",
-                )
-                saved += 1
-
-            if saved == 0:
-                update.message.reply_text(
-                    "❌ لم يتم حفظ أي بند، تأكد من صياغة رسالة الحصر."
-                )
-            else:
-                update.message.reply_text(
-                    f"✅ تم تحديث أعداد المواشي في تبويب \"المواشي - إجمالي\" ({saved} بنود).\n"
-                    f"التاريخ (للمعلومية فقط): {date_str}"
-                )
+            JOURNAL.submit("baseline", {"rows": rows})
         except Exception as e:
-            print("ERROR rebuilding livestock summary:", repr(e))
-            update.message.reply_text(
-                f"❌ حدث خطأ أثناء تحديث تبويب \"المواشي - إجمالي\":\n{e}"
-            )
+            print("ERROR journaling livestock baseline:", repr(e))
+            update.message.reply_text(f"❌ تعذر حفظ العملية:\n{e}")
+            return
+
+        update.message.reply_text(
+            f"✅ تم تحديث أعداد المواشي في تبويب \"المواشي - إجمالي\" ({len(rows)} بنود).\n"
+            f"التاريخ (للمعلومية فقط): {date_str}"
+        )
         return
 
     # ========= 2) تعديل مواشي بدون عملية مالية =========
     if intent == "livestock_change":
-        livestock_entries = ai_data.get("livestock_entries") or []
-        if not isinstance(livestock_entries, list) or not livestock_entries:
-            update.message.reply_text("❌ لا توجد تغييرات مواشي واضحة لتطبيقها.")
+        entries = payload.get("livestock") or []
+        if not entries:
+            update.message.reply_text("❌ لم يتم تطبيق أي تغيير، راجع صياغة الرسالة.")
             return
 
-        applied = 0
-        for e in livestock_entries:
-            animal_type = e.get("animal_type") or ""
-            breed = e.get("breed") or ""
-            movement = e.get("movement") or ""
-            count = e.get("count")
-            try:
-                count_val = int(float(count)) if count is not None else None
-            except Exception:
-                count_val = None
-            if count_val is None or count_val <= 0:
-                continue
-            update_livestock_summary(animal_type, breed, count_val, movement)
-            applied += 1
+        try:
+            JOURNAL.submit("livestock", {"livestock": entries})
+        except Exception as e:
+            print("ERROR journaling livestock changes:", repr(e))
+            update.message.reply_text(f"❌ تعذر حفظ العملية:\n{e}")
+            return
 
-        if applied == 0:
-            update.message.reply_text("❌ لم يتم تطبيق أي تغيير، راجع صياغة الرسالة.")
-        else:
-            update.message.reply_text(
-                f"✅ تم تطبيق {applied} تغيير/تغييرات على أعداد المواشي في تبويب \"المواشي - إجمالي\"."
-            )
+        update.message.reply_text(
+            f"✅ تم تطبيق {len(entries)} تغيير/تغييرات على أعداد المواشي في تبويب \"المواشي - إجمالي\"."
+        )
         return
 
     # ========= 3) عملية مالية (مع احتمال تعديل مواشي) =========
     if intent == "expense_create":
-        date_str = choose_date_from_ai(ai_data.get("date"), text)
-        process = ai_data.get("process") or "أخرى"
-        type_ = ai_data.get("type") or "اخرى"
-        item = ai_data.get("item") or ""
-        amount = ai_data.get("amount")
-        note = ai_data.get("note") or text
+        process = payload["process"]
+        type_ = payload["type"]
+        item = payload["item"]
+        amount = payload["amount"]
+        note = payload["note"]
+        person_name = payload["person"]
+        entries = payload.get("livestock") or []
 
         if amount is None:
-            m = re.search(r"(\d+(?:[.,]\d+)?)", text)
-            if not m:
-                update.message.reply_text("❌ لم أقدر أستخرج مبلغ. اذكر المبلغ كرقم واضح.")
-                return
-            amount = float(m.group(1).replace(",", "."))
-
-        try:
-            amount = float(amount)
-            if amount < 0:
-                amount = abs(amount)
-        except Exception:
-            update.message.reply_text("❌ المبلغ غير واضح، ارسله كرقم فقط.")
+            update.message.reply_text("❌ لم أقدر أستخرج مبلغ. اذكر المبلغ كرقم واضح.")
             return
 
-        person_name = USER_NAMES.get(
-            user_id, update.message.from_user.first_name or "مستخدم"
-        )
-
+        # نحفظ في السجل المحلي ونرد فوراً؛ الكتابة في Google Sheets تتم في الخلفية.
+        # الرصيد يُحسب الآن من الدفتر المحلي (O(1)) وقد يختلف عن المعاينة
+        # إذا سجّل المستخدم الآخر شيئاً بينهما.
+        row_values = [date_str, process, type_, item, amount, note, person_name]
         try:
-            sheet = get_expense_sheet()
-            rows = sheet.get_all_values()
+            prev_balance, new_balance = JOURNAL.submit_expense(row_values, entries)
         except Exception as e:
+            print("ERROR journaling expense:", repr(e))
             update.message.reply_text(f"❌ خطأ في الوصول إلى Google Sheets: {e}")
             return
 
-        prev_balance = compute_balance_from_rows(rows)
-        next_row_index = len(rows) + 1
+        balance_note = ""
+        expected = payload.get("prev_balance")
+        if expected is not None and expected != prev_balance:
+            balance_note = f"\nℹ️ الرصيد تغيّر منذ المعاينة ({expected} → {prev_balance})."
 
         signed_amount = amount if process == "بيع" else -amount
-        new_balance = round(prev_balance + signed_amount, 2)
 
-        # --- تعديل المواشي + تسجيل الميتا ---
-        livestock_entries = ai_data.get("livestock_entries") or []
         livestock_msg_lines = []
-        for e in livestock_entries:
-            animal_type = e.get("animal_type") or ""
-            breed = e.get("breed") or ""
-            movement = e.get("movement") or ""
-            count = e.get("count")
-            try:
-                count_val = int(float(count)) if count is not None else None
-            except Exception:
-                count_val = None
-            if count_val is None or count_val <= 0:
-                continue
-
-            try:
-                update_livestock_summary(animal_type, breed, count_val, movement)
-                minus_moves = {"بيع", "نقص", "نفوق"}
-                sign = -1 if movement in minus_moves else 1
-                delta_int = sign * count_val
-                log_livestock_meta(next_row_index, animal_type, breed, delta_int)
-                sign_str = "+" if delta_int >= 0 else "-"
-                livestock_msg_lines.append(
-                    f"{animal_type or '-'} | {breed or '-'} | التغيير: {sign_str}{abs(delta_int)} (الحركة: {movement})"
-                )
-            except Exception as e:
-                print("ERROR updating livestock summary from expense:", repr(e))
-                livestock_msg_lines.append(
-                    f"{animal_type or '-'} | {breed or '-'} | ⚠️ لم أستطع تحديثه (خطأ داخلي)"
-                )
-
-        try:
-            sheet.append_row(
-                [date_str, process, type_, item, amount, note, person_name, new_balance],
-                value_input_option="USER_ENTERED",
+        for e in entries:
+            delta_int = livestock_delta(e["movement"], e["count"])
+            sign_str = "+" if delta_int >= 0 else "-"
+            livestock_msg_lines.append(
+                f"{e['animal_type'] or '-'} | {e['breed'] or '-'} | التغيير: {sign_str}{abs(delta_int)} (الحركة: {e['movement']})"
             )
-        except Exception as e:
-            print("ERROR saving to sheet:", repr(e))
-            update.message.reply_text(f"❌ خطأ في الحفظ داخل Google Sheets:\n{e}")
-            return
 
         sign_str = "+" if signed_amount >= 0 else "-"
         livestock_msg = ""
@@ -946,6 +3614,7 @@ def confirm_command(update, context):
             f"💰 المبلغ: {amount}\n"
             f"👤 الشخص: {person_name}\n"
             f"📊 الرصيد بعد العملية: {new_balance} (التغيير: {sign_str}{abs(signed_amount)})"
+            f"{balance_note}"
             f"{livestock_msg}"
         )
         update.message.reply_text(msg)
@@ -964,13 +3633,20 @@ def balance_command(update, context):
         return
 
     try:
-        sheet = get_expense_sheet()
-        balance = compute_previous_balance(sheet)
+        balance = compute_previous_balance()
     except Exception as e:
         update.message.reply_text(f"❌ خطأ في قراءة الرصيد من Google Sheets:\n{e}")
         return
 
-    update.message.reply_text(f"💰 الرصيد الحالي في الدفتر: {balance}")
+    msg = f"💰 الرصيد الحالي في الدفتر: {balance}"
+    mismatch = LEDGER.balance_mismatch
+    if mismatch:
+        row_idx, stored, computed = mismatch
+        msg += (
+            f"\n⚠️ الرصيد المكتوب في الصف {row_idx} ({stored}) لا يطابق المحسوب ({computed})، "
+            "غالباً بسبب تعديل يدوي في الورقة."
+        )
+    update.message.reply_text(msg)
 
 
 def undo_command(update, context):
@@ -979,19 +3655,49 @@ def undo_command(update, context):
         update.message.reply_text("❌ غير مصرح لك")
         return
 
+    # نمسك قفل الكاتب: لا يُلحق أي صف جديد بين قراءة آخر صف وحذفه
+    with JOURNAL.writer():
+        _undo_last_operation(update)
+
+
+def _undo_last_operation(update):
+    # آخر عملية ما زالت في سجل الكتابة ولم تصل الورقة → نلغيها محلياً فقط
+    try:
+        cancelled = JOURNAL.cancel_last_expense()
+    except Exception as e:
+        print("ERROR cancelling journaled expense:", repr(e))
+        cancelled = None
+    if cancelled is not None:
+        update.message.reply_text(
+            "↩️ تم التراجع عن آخر عملية قبل كتابتها في Google Sheets:\n"
+            f"{cancelled[0]} | {cancelled[1]} | {cancelled[2]} | {cancelled[3] or '-'} | {cancelled[4]}\n"
+            f"الرصيد بعدها كان: {cancelled[7]}"
+        )
+        return
+
+    # نكتب ما تبقى في السجل أولاً حتى يكون آخر صف في الورقة هو آخر عملية فعلاً
+    try:
+        JOURNAL.flush_once()
+    except Exception as e:
+        print("ERROR flushing journal before undo:", repr(e))
+        update.message.reply_text(
+            "⏳ توجد عمليات لم تُكتب بعد في Google Sheets، حاول التراجع بعد قليل."
+        )
+        return
+
     try:
         sheet = get_expense_sheet()
-        rows = sheet.get_all_values()
+        # max_age=0: نقرأ الصف نفسه من الورقة للتأكد أنه ما زال آخر صف وكما نعرفه
+        last_row_index, last_row = LEDGER.last_row(max_age=0)
     except Exception as e:
         update.message.reply_text(f"❌ خطأ في الوصول إلى Google Sheets:\n{e}")
         return
 
-    if len(rows) <= 1:
+    if last_row_index is None:
         update.message.reply_text("ℹ️ لا توجد أي عملية لحذفها (الجدول فارغ).")
         return
 
-    last_row_index = len(rows)
-    last_row = rows[-1]
+    JOURNAL.mark_own_write()
 
     date_str = last_row[0] if len(last_row) > 0 else ""
     process = last_row[1] if len(last_row) > 1 else ""
@@ -1001,34 +3707,38 @@ def undo_command(update, context):
     balance_value = last_row[7] if len(last_row) > 7 else ""
 
     livestock_undo_msg = ""
-    meta_row_idx, meta = fetch_livestock_meta_for_row(last_row_index)
-    if meta:
+    metas = fetch_livestock_meta_for_row(last_row_index)
+    reverse_entries = []
+    for _, meta in metas:
+        delta_int = meta["delta"]
+        if delta_int == 0:
+            continue
+        reverse_entries.append(
+            {
+                "animal_type": meta["animal_type"] or "",
+                "breed": meta["breed"] or "",
+                "movement": "إضافة" if delta_int < 0 else "نقص",
+                "count": abs(delta_int),
+            }
+        )
+    if metas:
         try:
-            animal_type = meta.get("animal_type") or ""
-            breed = meta.get("breed") or ""
-            delta_int = int(float(meta.get("delta", 0)))
-            if delta_int != 0:
-                if delta_int < 0:
-                    movement = "إضافة"
-                    count = abs(delta_int)
-                    sign_str = "+"
-                else:
-                    movement = "نقص"
-                    count = delta_int
-                    sign_str = "-"
-                if count > 0:
-                    update_livestock_summary(animal_type, breed, count, movement)
-                    livestock_undo_msg = (
-                        f"\n🐑 تم عكس تعديل المواشي: {animal_type or '-'} | "
-                        f"{breed or '-'} | {sign_str}{count}"
-                    )
-                    if meta_row_idx:
-                        delete_meta_row(meta_row_idx)
+            apply_livestock_entries(reverse_entries)
+            undo_lines = []
+            for e in reverse_entries:
+                sign_str = "+" if e["movement"] == "إضافة" else "-"
+                undo_lines.append(
+                    f"{e['animal_type'] or '-'} | {e['breed'] or '-'} | {sign_str}{e['count']}"
+                )
+            if undo_lines:
+                livestock_undo_msg = "\n🐑 تم عكس تعديل المواشي:\n" + "\n".join(undo_lines)
+            delete_meta_rows([idx for idx, _ in metas])
         except Exception as e:
             print("ERROR undoing livestock from meta:", repr(e))
 
     try:
-        sheet.delete_rows(last_row_index)
+        _sheets_call(sheet.delete_rows, last_row_index)
+        LEDGER.delete_local(last_row_index)
         update.message.reply_text(
             "↩️ تم التراجع عن آخر عملية وحذفها من Google Sheets:\n"
             f"{date_str} | {process} | {type_} | {item or '-'} | {amount}\n"
@@ -1046,17 +3756,12 @@ def week_report(update, context):
         update.message.reply_text("❌ غير مصرح لك")
         return
 
-    expenses = load_expenses()
-    today = datetime.now().date()
-    start = today - timedelta(days=6)
-
-    income, expense, net = summarize_period(expenses, start, today)
+    windows = report_windows(["last_7_days"])
+    start, today = windows["last_7_days"]
+    summary = LEDGER.summarize_windows(windows)["last_7_days"]
 
     update.message.reply_text(
-        f"📅 ملخص آخر 7 أيام (من {start} إلى {today}):\n"
-        f"الدخل: +{income}\n"
-        f"المصاريف: -{expense}\n"
-        f"الصافي: {net:+}"
+        _summary_lines(f"📅 ملخص آخر 7 أيام (من {start} إلى {today})", summary)
     )
 
 
@@ -1065,17 +3770,12 @@ def month_report(update, context):
         update.message.reply_text("❌ غير مصرح لك")
         return
 
-    expenses = load_expenses()
-    today = datetime.now().date()
-    start = datetime(today.year, today.month, 1).date()
-
-    income, expense, net = summarize_period(expenses, start, today)
+    windows = report_windows(["this_month"])
+    _, today = windows["this_month"]
+    summary = LEDGER.summarize_windows(windows)["this_month"]
 
     update.message.reply_text(
-        f"📆 ملخص هذا الشهر ({today.year}-{today.month:02d}):\n"
-        f"الدخل: +{income}\n"
-        f"المصاريف: -{expense}\n"
-        f"الصافي: {net:+}"
+        _summary_lines(f"📆 ملخص هذا الشهر ({today.year}-{today.month:02d})", summary)
     )
 
 
@@ -1084,29 +3784,28 @@ def status_report(update, context):
         update.message.reply_text("❌ غير مصرح لك")
         return
 
-    expenses = load_expenses()
-    today = datetime.now().date()
-    week_start = today - timedelta(days=6)
-    month_start = datetime(today.year, today.month, 1).date()
-
-    inc_today, exp_today, net_today = summarize_period(expenses, today, today)
-    inc_week, exp_week, net_week = summarize_period(expenses, week_start, today)
-    inc_month, exp_month, net_month = summarize_period(expenses, month_start, today)
-
+    # كل النوافذ من مزامنة واحدة ونفس المجاميع اليومية
+    windows = report_windows(
+        ["today", "last_7_days", "this_month", "last_month", "this_year"]
+    )
+    today = windows["today"][1]
+    week_start = windows["last_7_days"][0]
+    last_month_start = windows["last_month"][0]
+    summaries = LEDGER.summarize_windows(windows)
+
+    sections = [
+        (f"📌 اليوم ({today})", "today"),
+        (f"📌 آخر 7 أيام (من {week_start} إلى {today})", "last_7_days"),
+        (f"📌 هذا الشهر ({today.year}-{today.month:02d})", "this_month"),
+        (
+            f"📌 الشهر الماضي ({last_month_start.year}-{last_month_start.month:02d})",
+            "last_month",
+        ),
+        (f"📌 منذ بداية السنة ({today.year})", "this_year"),
+    ]
     update.message.reply_text(
         "📊 ملخص الدخل والمصاريف:\n\n"
-        f"📌 اليوم ({today}):\n"
-        f"الدخل: +{inc_today}\n"
-        f"المصاريف: -{exp_today}\n"
-        f"الصافي: {net_today:+}\n\n"
-        f"📌 آخر 7 أيام (من {week_start} إلى {today}):\n"
-        f"الدخل: +{inc_week}\n"
-        f"المصاريف: -{exp_week}\n"
-        f"الصافي: {net_week:+}\n\n"
-        f"📌 هذا الشهر ({today.year}-{today.month:02d}):\n"
-        f"الدخل: +{inc_month}\n"
-        f"المصاريف: -{exp_month}\n"
-        f"الصافي: {net_month:+}"
+        + "\n\n".join(_summary_lines(title, summaries[name]) for title, name in sections)
     )
 
 
@@ -1117,17 +3816,180 @@ def livestock_status_command(update, context):
         reply_livestock_status(update)
 
 
+# ================== ANALYSIS PIPELINE ==================
+# عدد الخيوط التي تحلل الرسائل (ذكاء اصطناعي + Sheets) بعيداً عن خيوط الـ dispatcher
+ANALYSIS_WORKERS = int(os.environ.get("ANALYSIS_WORKERS", "4"))
+
+
+class UserLanes:
+    """مجموعة خيوط محدودة، ومهام كل مستخدم تُنفّذ بالترتيب واحدة بعد الأخرى.
+
+    بهذا لا يسبق /confirm المعاينة الخاصة به، ومستخدمان مختلفان لا ينتظر
+    أحدهما الآخر.
+    """
+
+    def __init__(self, max_workers):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="analysis"
+        )
+        self._lock = threading.Lock()
+        self._queues = {}  # user_id -> deque[(Future, fn, args)]
+
+    def submit(self, user_id, fn, *args):
+        fut = Future()
+        with self._lock:
+            queue = self._queues.get(user_id)
+            start_drain = queue is None
+            if start_drain:
+                queue = self._queues[user_id] = deque()
+            queue.append((fut, fn, args))
+        if start_drain:
+            self._executor.submit(self._drain, user_id)
+        return fut
+
+    def _drain(self, user_id):
+        while True:
+            with self._lock:
+                queue = self._queues.get(user_id)
+                if not queue:
+                    self._queues.pop(user_id, None)
+                    return
+                fut, fn, args = queue.popleft()
+            if not fut.set_running_or_notify_cancel():
+                continue
+            try:
+                fut.set_result(fn(*args))
+            except BaseException as e:
+                fut.set_exception(e)
+
+    def cancel_pending(self, user_id) -> int:
+        """نلغي مهام المستخدم التي لم تبدأ بعد؛ نرجع عددها."""
+        with self._lock:
+            queue = self._queues.get(user_id) or ()
+            return sum(1 for fut, _, _ in queue if fut.cancel())
+
+    def depth(self) -> int:
+        with self._lock:
+            return sum(len(q) for q in self._queues.values())
+
+
+USER_LANES = UserLanes(ANALYSIS_WORKERS)
+
+# /cancel يزيد الرقم؛ الرسالة التي بدأت قبل الإلغاء لا تنشئ معاينة بعده
+# { user_id: [generation, in_flight_count] }
+_CANCEL_STATE = {}
+_CANCEL_LOCK = threading.Lock()
+
+
+def _current_generation(user_id):
+    with _CANCEL_LOCK:
+        return _CANCEL_STATE.setdefault(user_id, [0, 0])[0]
+
+
+def _bump_cancel_generation(user_id) -> bool:
+    """نرجع True إذا كانت هناك رسالة قيد التحليل وقت الإلغاء."""
+    with _CANCEL_LOCK:
+        state = _CANCEL_STATE.setdefault(user_id, [0, 0])
+        state[0] += 1
+        return state[1] > 0
+
+
+def _cancelled_since(user_id, generation) -> bool:
+    return generation is not None and _current_generation(user_id) != generation
+
+
+def run_in_user_lane(handler):
+    """نغلف handler حتى يُنفّذ في طابور المستخدم ويرجع الـ dispatcher فوراً."""
+
+    def wrapper(update, context):
+        user_id = update.message.from_user.id
+
+        def task():
+            try:
+                handler(update, context)
+            except Exception as e:
+                print(f"ERROR in {handler.__name__}:", repr(e))
+                update.message.reply_text("❌ صار خطأ غير متوقع، حاول مرة ثانية.")
+
+        USER_LANES.submit(user_id, task)
+
+    wrapper.__name__ = handler.__name__
+    return wrapper
+
+
+# قراءات Sheets التي لا تعتمد على نتيجة التحليل نبدأها بالتوازي معه
+PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="prefetch")
+_PREFETCH_FOR_INTENT = {
+    "expense_create": ("ledger",),
+    "financial_query": ("ledger",),
+    "livestock_change": ("livestock",),
+    "livestock_status": ("livestock",),
+}
+
+
+def start_prefetch():
+    """نبدأ تحميل الدفتر (الرصيد + التجميع) وأعداد المواشي في الخلفية."""
+    return {
+        "ledger": PREFETCH_EXECUTOR.submit(LEDGER.prefetch),
+        "livestock": PREFETCH_EXECUTOR.submit(LIVESTOCK.ensure_fresh),
+    }
+
+
+def join_prefetch(prefetch, intent):
+    """ننتظر فقط ما تحتاجه هذه النية؛ الأخطاء تُسجل ويعيد المستدعي المحاولة بنفسه."""
+    for name in _PREFETCH_FOR_INTENT.get(intent, ()):
+        try:
+            prefetch[name].result(timeout=SHEETS_TIMEOUT)
+        except Exception as e:
+            print(f"Prefetch of {name} failed:", repr(e))
+
+
 # ================== MESSAGE HANDLER ==================
 def handle_message(update, context):
+    """نرد فوراً بـ "يكتب..." ونرسل التحليل لطابور المستخدم."""
     user_id = update.message.from_user.id
     if not authorized(update):
         update.message.reply_text("❌ غير مصرح لك")
         return
 
+    try:
+        context.bot.send_chat_action(
+            chat_id=update.message.chat_id, action=ChatAction.TYPING
+        )
+    except Exception as e:
+        print("ERROR sending chat action:", repr(e))
+
+    with _CANCEL_LOCK:
+        state = _CANCEL_STATE.setdefault(user_id, [0, 0])
+        generation = state[0]
+        state[1] += 1
+
+    received = time.monotonic()
+
+    def task():
+        try:
+            process_message(update, context, generation)
+        except Exception as e:
+            print("ERROR in process_message:", repr(e))
+            update.message.reply_text("❌ صار خطأ غير متوقع، حاول مرة ثانية.")
+        finally:
+            LATENCY["e2e"].observe(time.monotonic() - received)
+
+    def done(_):
+        # يُستدعى بعد انتهاء المهمة أو إلغائها من الطابور (/cancel)
+        with _CANCEL_LOCK:
+            _CANCEL_STATE[user_id][1] -= 1
+
+    USER_LANES.submit(user_id, task).add_done_callback(done)
+
+
+def process_message(update, context, generation=None):
+    user_id = update.message.from_user.id
     text = update.message.text
 
+    prefetch = start_prefetch()
     try:
-        ai_data = analyze_with_ai(text)
+        ai_data = classify_message(text)
     except Exception as e:
         print("ERROR in analyze_with_ai:", repr(e))
         update.message.reply_text(
@@ -1135,8 +3997,13 @@ def handle_message(update, context):
         )
         return
 
+    if _cancelled_since(user_id, generation):
+        print("Message cancelled by /cancel while analyzing, dropping result")
+        return
+
     intent = ai_data.get("intent") or "other"
     print("AI_INTENT:", intent)
+    join_prefetch(prefetch, intent)
 
     # 1) كشف المواشي
     if intent == "livestock_status":
@@ -1167,7 +4034,7 @@ def handle_message(update, context):
             update.message.reply_text("❌ البيانات غير واضحة، لم أستطع استخراج الأعداد.")
             return
 
-        PENDING_MESSAGES[user_id] = {"text": text, "ai": ai_data}
+        set_pending(update, user_id, text, ai_data)
 
         update.message.reply_text(
             "📨 تأكيد تسجيل المواشي (حصر كامل)\n"
@@ -1186,8 +4053,8 @@ def handle_message(update, context):
             update.message.reply_text("❌ لم أستطع فهم تغييرات المواشي من الرسالة.")
             return
 
-        PENDING_MESSAGES[user_id] = {"text": text, "ai": ai_data}
-        send_preview_message(update, user_id, text, ai_data)
+        payload = set_pending(update, user_id, text, ai_data)
+        send_preview_message(update, user_id, text, ai_data, payload)
         return
 
     # 4) استعلام مالي
@@ -1197,8 +4064,8 @@ def handle_message(update, context):
 
     # 5) عملية مالية (مع أو بدون مواشي)
     if intent == "expense_create":
-        PENDING_MESSAGES[user_id] = {"text": text, "ai": ai_data}
-        send_preview_message(update, user_id, text, ai_data)
+        payload = set_pending(update, user_id, text, ai_data)
+        send_preview_message(update, user_id, text, ai_data, payload)
         return
 
     # 6) أي شيء آخر
@@ -1207,47 +4074,213 @@ def handle_message(update, context):
     )
 
 
-# ================== HEALTH SERVER (لـ Render) ==================
-def start_health_server():
-    port = int(os.environ.get("PORT", "10000"))
+# ================== HTTP SERVER (صحة Render + Webhook) ==================
+PORT = int(os.environ.get("PORT", "10000"))
+# إذا حُدد WEBHOOK_URL نستقبل التحديثات على نفس المنفذ بدل long polling
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_PATH = f"/{BOT_TOKEN}"
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def health_report():
+    """(سليم؟, نص) حسب آخر نجاح/فشل لكل خدمة وحجم الطوابير."""
+    healthy = True
+    lines = []
+    for dep in DEPENDENCIES:
+        up = dependency_up(dep)
+        healthy = healthy and up
+        if up:
+            lines.append(f"{dep}: ok")
+        else:
+            lines.append(f"{dep}: error {DEPENDENCY_STATE[dep]['last_error']}")
+    lines.append(f"pending_confirmations: {PENDING.size()}")
+    lines.append(f"journal_entries: {JOURNAL.size()}")
+    lines.append(f"queue_depth: {USER_LANES.depth()}")
+    return healthy, "\n".join(lines)
+
+
+def render_metrics():
+    """كل المقاييس بصيغة Prometheus النصية."""
+    lines = [
+        "# HELP azba_latency_seconds Latency of hot-path operations.",
+        "# TYPE azba_latency_seconds histogram",
+    ]
+    for op, hist in LATENCY.items():
+        lines.extend(hist.render("azba_latency_seconds", f'op="{op}"'))
+
+    lines += [
+        "# HELP azba_cache_hit_ratio Hit ratio of in-process caches.",
+        "# TYPE azba_cache_hit_ratio gauge",
+        f'azba_cache_hit_ratio{{cache="ai_response"}} {AI_CACHE.hit_rate()}',
+        f'azba_cache_hit_ratio{{cache="fast_path"}} {fast_path_hit_rate()}',
+        "# HELP azba_pending_confirmations Operations waiting for /confirm.",
+        "# TYPE azba_pending_confirmations gauge",
+        f"azba_pending_confirmations {PENDING.size()}",
+        "# HELP azba_queue_depth Queued work items.",
+        "# TYPE azba_queue_depth gauge",
+        f'azba_queue_depth{{queue="analysis"}} {USER_LANES.depth()}',
+        f'azba_queue_depth{{queue="journal"}} {JOURNAL.size()}',
+    ]
+
+    with _SHEETS_STATS_LOCK:
+        stats = dict(SHEETS_STATS)
+    lines += [
+        "# HELP azba_sheets_calls_total Google Sheets calls by kind.",
+        "# TYPE azba_sheets_calls_total counter",
+        f'azba_sheets_calls_total{{kind="read"}} {stats["read_calls"]}',
+        f'azba_sheets_calls_total{{kind="write"}} {stats["write_calls"]}',
+        "# TYPE azba_sheets_retries_total counter",
+        f"azba_sheets_retries_total {stats['retries']}",
+        "# TYPE azba_sheets_errors_total counter",
+        f"azba_sheets_errors_total {stats['errors']}",
+        "# TYPE azba_sheets_throttle_waits_total counter",
+        f"azba_sheets_throttle_waits_total {stats['throttle_waits']}",
+        "# TYPE azba_sheets_throttle_wait_seconds_total counter",
+        f"azba_sheets_throttle_wait_seconds_total {stats['throttle_wait_seconds']}",
+    ]
+
+    lines += [
+        "# HELP azba_dependency_up 0 after repeated recent failures of the dependency.",
+        "# TYPE azba_dependency_up gauge",
+    ]
+    errors = []
+    with _DEPENDENCY_LOCK:
+        states = {dep: dict(state) for dep, state in DEPENDENCY_STATE.items()}
+    now = time.time()
+    for dep, state in states.items():
+        up = 1 if _state_up(state, now) else 0
+        lines.append(f'azba_dependency_up{{dependency="{dep}"}} {up}')
+        if state["last_error"]:
+            errors.append(
+                f'azba_dependency_last_error_timestamp_seconds{{dependency="{dep}",'
+                f'error="{_label_value(state["last_error"])}"}} {state["last_error_at"]}'
+            )
+    lines += [
+        "# HELP azba_dependency_last_error_timestamp_seconds Time and text of the last error.",
+        "# TYPE azba_dependency_last_error_timestamp_seconds gauge",
+    ] + errors
+    return "\n".join(lines) + "\n"
+
+
+def make_http_server(dispatcher=None):
+    """سيرفر HTTP متعدد الخيوط: /health و /metrics، و POST على WEBHOOK_PATH
+    (إذا مررنا dispatcher) يضع التحديث في طابور الـ dispatcher مباشرة."""
 
     class Handler(http.server.BaseHTTPRequestHandler):
-        def do_GET(self):
-            self.send_response(200)
-            self.send_header("Content-type", "text/plain; charset=utf-8")
+        def _reply(self, code, body=b"", content_type="text/plain; charset=utf-8"):
+            self.send_response(code)
+            self.send_header("Content-type", content_type)
+            self.send_header("Content-Length", str(len(body)))
             self.end_headers()
-            self.wfile.write(b"OK")
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = self.path.split("?", 1)[0]
+            try:
+                if path == "/metrics":
+                    self._reply(
+                        200,
+                        render_metrics().encode("utf-8"),
+                        "text/plain; version=0.0.4; charset=utf-8",
+                    )
+                elif path == "/health":
+                    healthy, report = health_report()
+                    self._reply(200 if healthy else 503, report.encode("utf-8"))
+                else:
+                    self._reply(200, b"OK")
+            except Exception as e:
+                print("ERROR serving", path, repr(e))
+                self._reply(500)
+
+        def do_POST(self):
+            if dispatcher is None or self.path != WEBHOOK_PATH:
+                self._reply(404)
+                return
+            if WEBHOOK_SECRET and (
+                self.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET
+            ):
+                self._reply(403)
+                return
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+                data = json.loads(self.rfile.read(length).decode("utf-8"))
+                update = Update.de_json(data, dispatcher.bot)
+            except Exception as e:
+                print("ERROR parsing webhook update:", repr(e))
+                self._reply(400)
+                return
+            dispatcher.update_queue.put(update)
+            self._reply(200)
 
         def log_message(self, format, *args):
             return
 
-    with socketserver.TCPServer(("", port), Handler) as httpd:
-        print(f"Health server running on port {port}")
-        httpd.serve_forever()
+    httpd = http.server.ThreadingHTTPServer(("", PORT), Handler)
+    httpd.daemon_threads = True
+    return httpd
+
+
+def start_health_server():
+    httpd = make_http_server()
+    print(f"Health server running on port {PORT}")
+    httpd.serve_forever()
 
 
 # ================== MAIN ==================
+
 def main():
-    # سيرفر صحة لـ Render
-    server_thread = threading.Thread(target=start_health_server, daemon=True)
-    server_thread.start()
+    # سيرفر صحة لـ Render (في وضع webhook نفس السيرفر يستقبل التحديثات)
+    if not WEBHOOK_URL:
+        server_thread = threading.Thread(target=start_health_server, daemon=True)
+        server_thread.start()
+
+    # نحفظ كاش الذكاء الاصطناعي عند الإغلاق
+    atexit.register(AI_CACHE.save)
+
+    # قاعدة العمليات المعلقة تُفتح هنا وليس عند الاستيراد
+    PENDING.open()
+
+    # عميل Sheets واحد + تجديد التوكن في الخلفية
+    start_token_refresher()
+
+    # نبدأ من اللقطة المحلية ونطابقها مع Sheets في الخلفية
+    load_snapshot()
+    atexit.register(save_snapshot)
+    start_snapshot_sync()
+    CHANGES.start()
+
+    # كاتب Google Sheets في الخلفية (يكمل أي عمليات بقيت في السجل قبل الإغلاق)
+    JOURNAL.start()
 
     print("Starting Telegram bot...")
     updater = Updater(BOT_TOKEN, use_context=True)
     dp = updater.dispatcher
 
+    # الـ handlers تعمل على خيط الـ dispatcher بالترتيب (بدون run_async) وترجع فوراً:
+    # العمل الثقيل في USER_LANES، والترتيب هنا هو ما يضمن ترتيب رسائل كل مستخدم
+
     dp.add_handler(CommandHandler("start", start_command))
     dp.add_handler(CommandHandler("help", help_command))
     dp.add_handler(CommandHandler("cancel", cancel_command))
-    dp.add_handler(CommandHandler("confirm", confirm_command))
-    dp.add_handler(CommandHandler("balance", balance_command))
-    dp.add_handler(CommandHandler("undo", undo_command))
-    dp.add_handler(CommandHandler("week", week_report))
-    dp.add_handler(CommandHandler("month", month_report))
-    dp.add_handler(CommandHandler("status", status_report))
-    dp.add_handler(CommandHandler("livestock", livestock_status_command))
+    # الأوامر التي تلمس الدفتر تمر بطابور المستخدم حتى تحترم ترتيب رسائله
+    dp.add_handler(CommandHandler("confirm", run_in_user_lane(confirm_command)))
+    dp.add_handler(CommandHandler("balance", run_in_user_lane(balance_command)))
+    dp.add_handler(CommandHandler("undo", run_in_user_lane(undo_command)))
+    dp.add_handler(CommandHandler("week", run_in_user_lane(week_report)))
+    dp.add_handler(CommandHandler("month", run_in_user_lane(month_report)))
+    dp.add_handler(CommandHandler("status", run_in_user_lane(status_report)))
+    dp.add_handler(CommandHandler("livestock", run_in_user_lane(livestock_status_command)))
     dp.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_message))
 
+    if WEBHOOK_URL:
+        run_webhook(updater)
+        return
+
     # نحذف أي Webhook قديم
     try:
         updater.bot.delete_webhook()
@@ -1261,5 +4294,43 @@ def main():
     updater.idle()
 
 
+def run_webhook(updater):
+    """وضع webhook: تيليجرام يرسل التحديثات إلى WEBHOOK_URL + WEBHOOK_PATH على PORT."""
+    dp = updater.dispatcher
+    httpd = make_http_server(dp)
+    threading.Thread(target=dp.start, name="dispatcher", daemon=True).start()
+
+    try:
+        updater.bot.set_webhook(
+            url=WEBHOOK_URL + WEBHOOK_PATH,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            drop_pending_updates=True,
+            secret_token=WEBHOOK_SECRET or None,
+        )
+        me = updater.bot.get_me()
+        print(f"Bot connected as @{me.username}")
+    except Exception as e:
+        print("ERROR setting Telegram webhook:", repr(e))
+
+    def stop(signum, frame):
+        # shutdown() ينتظر انتهاء serve_forever على هذا الخيط نفسه → من خيط آخر
+        print(f"Received signal {signum}, stopping webhook server...")
+        threading.Thread(target=httpd.shutdown, name="webhook-shutdown").start()
+
+    # مثل updater.idle() في وضع polling: SIGTERM (إعادة نشر Render) ينهي main
+    # بشكل طبيعي فتعمل atexit (save_snapshot و AI_CACHE.save)
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, stop)
+
+    print(f"Bot is now receiving updates via webhook on port {PORT}...")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        dp.stop()
+
+
 if __name__ == "__main__":
     main()